@@ -0,0 +1,139 @@
+"""
+Export pipeline throughput benchmark.
+
+Generates synthetic bank fixtures and runs the export pipeline of main.py against them with replayed
+bank responses: fetch and parse, dedup, rendering in the chosen formats, email delivery when SMTP_*
+variables are set and --email is given, and the SQLite insert. The database is seeded with as many
+other transactions first, then every size is exported twice: with all transactions new and with all
+of them already stored. Stage times are taken from the run metrics, stages run in parallel threads,
+so their times may add up to more than the total. Run from the repository root:
+
+    python -m benchmarks.pipeline --rows 10000 100000 1000000 --formats csv ofx --output bench.json
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from datetime import date, timedelta
+from pathlib import Path
+
+from src.raiffeisen_rs.replay import generate_fixtures
+from src.repositories.transactions.sqlite.core import SQLite
+from src.utils.email import SMTP
+from src.utils.iterables import batched
+from src.utils.metrics import metrics
+
+DAYS = 30
+
+
+def seed(db: SQLite, api, batch_size: int):
+    """Store as many transactions as the fixtures have, with other ids, so dedup runs against a filled table."""
+
+    for account in api.accounts:
+        transactions = account.get_transactions()
+        rows = ({**transaction.to_dict(), 'id': f'{transaction.id}-seed', 'account': account.number}
+                for transaction in transactions)
+        for batch in batched(rows, batch_size):
+            db.upsert(batch)
+
+
+def run(exporter, rows: int, accounts: int, args, work_dir: Path) -> dict[str, dict[str, float]]:
+    fixture_dir = work_dir / 'fixtures'
+    generate_fixtures(fixture_dir, accounts=accounts, transactions=rows // accounts, days=DAYS)
+    exporter.settings = settings = replace(
+        exporter.settings,
+        only_new=True,
+        repository='sqlite',
+        db_file=str(work_dir / 'db.sqlite'),
+        save_to_csv=True,
+        csv_file_dir=str(work_dir),
+        export_formats=args.formats,
+        batch_size=args.batch_size,
+        replay_dir=str(fixture_dir),
+        record_dir=None,
+        session_cache_dir=None,
+        skip_unchanged_balances=False,
+    )
+    profile = replace(settings.profiles[0], wallet_emails={})
+    end_date = date.today()
+    start_date = end_date - timedelta(days=DAYS)
+
+    api = exporter.connect(profile)
+    if args.email:
+        profile.wallet_emails = {account.id: args.email for account in api.accounts}
+    smtp = SMTP(
+        username=settings.smtp_settings.username,
+        password=settings.smtp_settings.password,
+        host=settings.smtp_settings.host,
+        port=settings.smtp_settings.port,
+        use_tls=settings.smtp_settings.use_tls,
+    ) if settings.smtp_settings and args.email else None
+    render_pool = ProcessPoolExecutor(max_workers=args.render_workers) if args.render_workers else None
+    db = SQLite(settings.db_file)
+
+    results = {}
+    try:
+        seed(db, api, args.batch_size)
+        for name in ('new', 'existing'):
+            metrics.reset()
+            started_at = time.perf_counter()
+            errors = exporter.export_accounts(profile, api, api.accounts, db, smtp, start_date, end_date, render_pool)
+            if smtp:
+                smtp.results()
+            if errors:
+                raise errors[0].error
+            results[name] = {
+                'total': time.perf_counter() - started_at,
+                **{timer_name: timer['total'] for timer_name, timer in metrics.summary()['timers'].items()},
+            }
+    finally:
+        db.close()
+        if smtp:
+            smtp.close()
+        if render_pool:
+            render_pool.shutdown()
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the export pipeline on synthetic data.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="Total numbers of transactions to benchmark.")
+    parser.add_argument('--accounts', type=int, default=4, help="Number of accounts.")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Pipeline batch size.")
+    parser.add_argument('--formats', nargs='+', default=['csv'], help="Export formats to render.")
+    parser.add_argument('--render-workers', type=int, default=0, help="Number of render processes.")
+    parser.add_argument('--email', help="Send exports to this address over the SMTP server set by SMTP_* variables.")
+    parser.add_argument('--output', help="Write results as JSON to this file.")
+    args = parser.parse_args()
+
+    # Settings of main.py are loaded from the environment on import, the benchmark overrides them per run
+    sys.argv[1:] = []
+    os.environ.setdefault('USERNAME', 'benchmark')
+    os.environ.setdefault('PASSWORD_HASH', 'benchmark')
+    os.environ.setdefault('SAVE_TO_CSV', '1')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import main as exporter
+
+    results = {}
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results[rows] = run(exporter, rows, args.accounts, args, Path(work_dir))
+        for name, timings in results[rows].items():
+            total = timings['total']
+            print(f"{rows} rows, {name}: total {total:.2f}s ({rows / total:.0f} rows/s)")
+            for stage, seconds in timings.items():
+                if stage != 'total':
+                    print(f"  {stage:<40} {seconds:8.3f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
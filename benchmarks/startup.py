@@ -0,0 +1,68 @@
+"""
+Startup time benchmark.
+
+Measures how long a fresh interpreter takes to import main.py with all the modules it uses,
+whether pandas is loaded on the way, and compares it with eagerly importing pandas
+as the exporter did before. Run from the repository root:
+
+    python -m benchmarks.startup --runs 20
+"""
+import os
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# main.py imports everything the exporter runs with, its settings are loaded on import
+MODULES = ('main',)
+
+# Settings main.py requires, the benchmark doesn't connect anywhere
+ENVIRONMENT = {
+    'USERNAME': 'benchmark',
+    'PASSWORD_HASH': 'benchmark',
+    'SAVE_TO_CSV': '1',
+}
+
+IMPORT_SCRIPT = """
+import sys, time
+sys.argv[1:] = []
+started_at = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+print(time.perf_counter() - started_at, 'pandas' in sys.modules)
+"""
+
+
+def measure(modules: tuple[str, ...], runs: int) -> tuple[list[float], bool]:
+    import_times = []
+    pandas_loaded = False
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT.format(modules=modules)],
+            cwd=ROOT, env={**ENVIRONMENT, **os.environ}, capture_output=True, text=True, check=True,
+        )
+        import_time, pandas_in_modules = result.stdout.split()
+        import_times.append(float(import_time))
+        pandas_loaded = pandas_loaded or pandas_in_modules == 'True'
+    return import_times, pandas_loaded
+
+
+def report(name: str, import_times: list[float], pandas_loaded: bool):
+    print(f"{name}: median {statistics.median(import_times) * 1000:.1f} ms, "
+          f"min {min(import_times) * 1000:.1f} ms, pandas imported: {pandas_loaded}")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark import time of the exporter modules.")
+    parser.add_argument('--runs', type=int, default=10, help="Number of fresh interpreters to start.")
+    args = parser.parse_args()
+
+    report("exporter", *measure(MODULES, args.runs))
+    report("exporter + eager pandas", *measure(('pandas',) + MODULES, args.runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
+import json
 from argparse import ArgumentParser
 from dataclasses import dataclass, field
 from os import environ
 
+from src.utils.compression import COMPRESSION_MODES
+from src.utils.exporters import EXPORTERS
+from src.utils.metrics import METRICS_FORMATS
+
+REPOSITORIES = ("sqlite", "parquet")
+
 
 @dataclass
 class SMTPSettings:
@@ -13,18 +20,73 @@ class SMTPSettings:
 
 
 @dataclass
-class Settings:
+class Profile:
     username: str
     password_hash: str = field(repr=False)
+    wallet_emails: dict[str, str] = field(default_factory=dict)
+    poll_intervals: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class SQLiteSettings:
+    journal_mode: str | None = "WAL"
+    synchronous: str | None = "NORMAL"
+    cache_size: int | None = None
+    mmap_size: int | None = None
+    busy_timeout: int = 5000
+    bloom_filter: bool = False
+
+
+@dataclass
+class HTTPSettings:
+    connect_timeout: float = 10.0
+    read_timeout: float = 120.0
+    retries: int = 3
+    backoff_factor: float = 0.5
+
+
+@dataclass
+class Settings:
+    profiles: list[Profile]
     max_transaction_age_days: int
     min_transaction_age_days: int
     only_new: bool
     db_file: str | None
     save_to_csv: bool
     csv_file_dir: str
-    wallet_emails: dict[str, str]
     smtp_settings: SMTPSettings | None
     log_level: str = "INFO"
+    repository: str = "sqlite"
+    archive_dir: str = "archive"
+    max_workers: int = 1
+    profile_workers: int = 1
+    chunk_days: int | None = None
+    chunk_workers: int = 1
+    chunk_retries: int = 0
+    sync_overlap_days: int = 1
+    skip_unchanged_balances: bool = False
+    batch_size: int = 1000
+    pipeline_workers: int = 2
+    pipeline_queue_size: int = 4
+    session_cache_dir: str | None = None
+    session_cache_ttl: int = 600
+    record_dir: str | None = None
+    attachment_compression: str | None = None
+    export_formats: list[str] = field(default_factory=lambda: ["csv"])
+    split_by_month: bool = False
+    render_workers: int = 0
+    replay_dir: str | None = None
+    stream_responses: bool = False
+    daemon: bool = False
+    poll_interval: int = 900
+    poll_jitter: int = 60
+    health_host: str = "127.0.0.1"
+    health_port: int | None = None
+    metrics_file: str | None = None
+    metrics_format: str = "json"
+    profile_file: str | None = None
+    sqlite_settings: SQLiteSettings = field(default_factory=SQLiteSettings)
+    http_settings: HTTPSettings = field(default_factory=HTTPSettings)
 
 
 def get_parser() -> ArgumentParser:
@@ -38,6 +100,8 @@ def get_parser() -> ArgumentParser:
     parser.add_argument('-s', '--skip-days', help="Skip transactions younger than X days.")
     parser.add_argument('-n', '--new', help="Export only new transactions.")
     parser.add_argument('-b', '--db', help="Database file.")
+    parser.add_argument('--repository', choices=REPOSITORIES, help="Transaction repository, sqlite or parquet.")
+    parser.add_argument('--archive-dir', help="Parquet archive directory.")
     parser.add_argument('-c', '--csv', help="Save transactions to CSV file.")
     parser.add_argument('--path', help="CSV file directory.")
     parser.add_argument(
@@ -45,15 +109,98 @@ def get_parser() -> ArgumentParser:
         action='append',
         help="Wallet email. Format: 'raiffeisen_account_number:wallet_email'. You can use multiple -e arguments.")
     parser.add_argument('-f', '--file', help="Wallet email file.")
+    parser.add_argument(
+        '--profiles',
+        help="JSON file with a list of profiles to export in one batch. "
+             "Format: [{'username': ..., 'password_hash': ..., 'wallet_emails': {account: email}}].")
+    parser.add_argument('--profile-workers', type=int, help="Max number of profiles exported concurrently.")
+    parser.add_argument(
+        '--attachment-compression',
+        choices=COMPRESSION_MODES,
+        help="Compress email attachments.")
+    parser.add_argument(
+        '--export-formats',
+        help=f"Comma separated export formats, the first one is sent via email. "
+             f"Supported formats are {', '.join(EXPORTERS)}. Default is csv.")
+    parser.add_argument('--split-by-month', help="Save a separate file for every month of transactions.")
+    parser.add_argument(
+        '--render-workers',
+        type=int,
+        help="Number of processes rendering export files. Default is 0 (render in the pipeline threads).")
     parser.add_argument('--smtp-host', help="SMTP host.")
     parser.add_argument('--smtp-port', help="SMTP port.")
     parser.add_argument('--smtp-username', help="SMTP username.")
     parser.add_argument('--smtp-password', help="SMTP password.")
     parser.add_argument('--smtp-use-tls', help="SMTP use TLS.")
+    parser.add_argument(
+        '--skip-unchanged-balances',
+        help="Skip getting transactions of accounts whose balance hasn't changed since the last sync.")
+    parser.add_argument('--batch-size', type=int, help="Number of transactions processed at once per account.")
+    parser.add_argument(
+        '--pipeline-workers',
+        type=int,
+        help="Number of accounts deduplicated, rendered and delivered concurrently.")
+    parser.add_argument('--pipeline-queue-size', type=int, help="Max number of accounts waiting between stages.")
+    parser.add_argument('--session-cache-dir', help="Directory to cache logged in sessions in between runs.")
+    parser.add_argument('--session-cache-ttl', type=int, help="Cached session lifetime in seconds.")
+    parser.add_argument('--record', help="Directory to record bank responses to.")
+    parser.add_argument('--replay', help="Directory to replay recorded bank responses from instead of the bank.")
+    parser.add_argument(
+        '--stream-responses',
+        help="Stream-parse transaction responses row by row to lower peak memory, requires ijson.")
+    parser.add_argument('--daemon', help="Keep running and poll accounts on a schedule instead of exporting once.")
+    parser.add_argument('--poll-interval', type=int, help="Seconds between polls of an account in daemon mode.")
+    parser.add_argument('--poll-jitter', type=int, help="Max random delay in seconds added to every poll.")
+    parser.add_argument('--health-host', help="Host of the health and metrics endpoint in daemon mode.")
+    parser.add_argument('--health-port', type=int, help="Port of the health and metrics endpoint in daemon mode.")
+    parser.add_argument('--http-connect-timeout', type=float, help="HTTP connect timeout in seconds.")
+    parser.add_argument('--http-read-timeout', type=float, help="HTTP read timeout in seconds.")
+    parser.add_argument('--http-retries', type=int, help="Number of retries for failed bank requests.")
+    parser.add_argument('--http-backoff', type=float, help="Base delay in seconds for retry backoff.")
+    parser.add_argument('--sqlite-journal-mode', help="SQLite journal mode, e.g. WAL or DELETE.")
+    parser.add_argument('--sqlite-synchronous', help="SQLite synchronous mode, e.g. NORMAL or FULL.")
+    parser.add_argument('--sqlite-cache-size', type=int, help="SQLite cache size (pages, or KiB if negative).")
+    parser.add_argument('--sqlite-mmap-size', type=int, help="SQLite memory-mapped I/O size in bytes.")
+    parser.add_argument('--sqlite-busy-timeout', type=int, help="SQLite busy timeout in milliseconds.")
+    parser.add_argument(
+        '--sqlite-bloom-filter',
+        help="Keep a Bloom filter of stored transaction ids next to the database for faster dedup.")
     parser.add_argument('--log-level', help="Log level.")
+    parser.add_argument('--metrics-file', help="File to write the run summary of stage timings and counters to.")
+    parser.add_argument('--metrics-format', choices=METRICS_FORMATS, help="Run summary format, json or prometheus.")
+    parser.add_argument('--profile', help="File to dump cProfile stats of all threads of the run to.")
+    parser.add_argument('-w', '--workers', type=int, help="Max number of accounts fetched concurrently.")
+    parser.add_argument('--chunk-days', type=int, help="Split export period into chunks of X days.")
+    parser.add_argument('--chunk-workers', type=int, help="Max number of chunks fetched concurrently per account.")
+    parser.add_argument('--chunk-retries', type=int, help="Number of retries for a failed chunk.")
+    parser.add_argument(
+        '--overlap-days',
+        type=int,
+        help="Days to re-fetch before the last synced transaction to catch late-posted ones.")
     return parser
 
 
+def load_profiles(profiles_file: str, default_wallet_emails: dict[str, str]) -> list[Profile]:
+    with open(profiles_file, 'r') as f:
+        items = json.load(f)
+
+    profiles = []
+    for item in items:
+        if not item.get('username'):
+            raise ValueError(f"Username is required for every profile in {profiles_file}.")
+
+        if not item.get('password_hash'):
+            raise ValueError(f"Password hash is required for profile {item['username']}.")
+
+        profiles.append(Profile(
+            username=item['username'],
+            password_hash=item['password_hash'],
+            wallet_emails=item.get('wallet_emails') or default_wallet_emails,
+            poll_intervals=item.get('poll_intervals') or {},
+        ))
+    return profiles
+
+
 def load_settings() -> Settings:
     parser = get_parser()
     args = parser.parse_args()
@@ -82,6 +229,8 @@ def load_settings() -> Settings:
         else bool(environ.get("ONLY_NEW", False))
     )
     db_file = args.db or environ.get("DB_FILE", "db.sqlite")
+    repository = args.repository or environ.get("REPOSITORY", "sqlite")
+    archive_dir = args.archive_dir or environ.get("ARCHIVE_DIR", "archive")
     save_to_csv = (
             args.csv
             if args.csv is not None
@@ -89,7 +238,24 @@ def load_settings() -> Settings:
     )
     csv_file_dir = args.path or environ.get("CSV_FILE_DIR", ".")
     wallet_email_file = args.file or environ.get("WALLET_EMAIL_FILE")
+    profiles_file = args.profiles or environ.get("PROFILES_FILE")
     wallet_emails = args.email or environ.get("WALLET_EMAILS").split(',') if environ.get("WALLET_EMAILS") else []
+    attachment_compression = args.attachment_compression or environ.get("ATTACHMENT_COMPRESSION")
+    export_formats = [
+        export_format.strip()
+        for export_format in (args.export_formats or environ.get("EXPORT_FORMATS", "csv")).split(",")
+        if export_format.strip()
+    ]
+    split_by_month = (
+        bool(args.split_by_month)
+        if args.split_by_month is not None
+        else bool(environ.get("SPLIT_BY_MONTH", False))
+    )
+    render_workers = (
+        args.render_workers
+        if args.render_workers is not None
+        else int(environ.get("RENDER_WORKERS", 0))
+    )
     smtp_host = args.smtp_host or environ.get("SMTP_HOST")
     smtp_port = args.smtp_port or int(environ.get("SMTP_PORT", 587))
     smtp_username = args.smtp_username or environ.get("SMTP_USERNAME")
@@ -99,12 +265,142 @@ def load_settings() -> Settings:
         if args.smtp_use_tls is not None
         else bool(environ.get("SMTP_USE_TLS", True))
     )
+    skip_unchanged_balances = (
+        bool(args.skip_unchanged_balances)
+        if args.skip_unchanged_balances is not None
+        else bool(environ.get("SKIP_UNCHANGED_BALANCES", False))
+    )
+    batch_size = (
+        args.batch_size
+        if args.batch_size is not None
+        else int(environ.get("BATCH_SIZE", 1000))
+    )
+    pipeline_workers = (
+        args.pipeline_workers
+        if args.pipeline_workers is not None
+        else int(environ.get("PIPELINE_WORKERS", 2))
+    )
+    pipeline_queue_size = (
+        args.pipeline_queue_size
+        if args.pipeline_queue_size is not None
+        else int(environ.get("PIPELINE_QUEUE_SIZE", 4))
+    )
+    session_cache_dir = args.session_cache_dir or environ.get("SESSION_CACHE_DIR")
+    session_cache_ttl = (
+        args.session_cache_ttl
+        if args.session_cache_ttl is not None
+        else int(environ.get("SESSION_CACHE_TTL", 600))
+    )
+    record_dir = args.record or environ.get("RECORD_DIR")
+    replay_dir = args.replay or environ.get("REPLAY_DIR")
+    stream_responses = (
+        bool(args.stream_responses)
+        if args.stream_responses is not None
+        else bool(environ.get("STREAM_RESPONSES", False))
+    )
+    daemon = (
+        bool(args.daemon)
+        if args.daemon is not None
+        else bool(environ.get("DAEMON", False))
+    )
+    poll_interval = (
+        args.poll_interval
+        if args.poll_interval is not None
+        else int(environ.get("POLL_INTERVAL", 900))
+    )
+    poll_jitter = (
+        args.poll_jitter
+        if args.poll_jitter is not None
+        else int(environ.get("POLL_JITTER", 60))
+    )
+    health_host = args.health_host or environ.get("HEALTH_HOST", "127.0.0.1")
+    health_port = (
+        args.health_port
+        if args.health_port is not None
+        else int(environ["HEALTH_PORT"]) if environ.get("HEALTH_PORT") else None
+    )
+    metrics_file = args.metrics_file or environ.get("METRICS_FILE")
+    metrics_format = args.metrics_format or environ.get("METRICS_FORMAT", "json")
+    profile_file = args.profile or environ.get("PROFILE_FILE")
+    http_connect_timeout = (
+        args.http_connect_timeout
+        if args.http_connect_timeout is not None
+        else float(environ.get("HTTP_CONNECT_TIMEOUT", 10))
+    )
+    http_read_timeout = (
+        args.http_read_timeout
+        if args.http_read_timeout is not None
+        else float(environ.get("HTTP_READ_TIMEOUT", 120))
+    )
+    http_retries = (
+        args.http_retries
+        if args.http_retries is not None
+        else int(environ.get("HTTP_RETRIES", 3))
+    )
+    http_backoff = (
+        args.http_backoff
+        if args.http_backoff is not None
+        else float(environ.get("HTTP_BACKOFF", 0.5))
+    )
+    sqlite_journal_mode = args.sqlite_journal_mode or environ.get("SQLITE_JOURNAL_MODE", "WAL")
+    sqlite_synchronous = args.sqlite_synchronous or environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+    sqlite_cache_size = (
+        args.sqlite_cache_size
+        if args.sqlite_cache_size is not None
+        else int(environ["SQLITE_CACHE_SIZE"]) if environ.get("SQLITE_CACHE_SIZE") else None
+    )
+    sqlite_mmap_size = (
+        args.sqlite_mmap_size
+        if args.sqlite_mmap_size is not None
+        else int(environ["SQLITE_MMAP_SIZE"]) if environ.get("SQLITE_MMAP_SIZE") else None
+    )
+    sqlite_busy_timeout = (
+        args.sqlite_busy_timeout
+        if args.sqlite_busy_timeout is not None
+        else int(environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+    )
+    sqlite_bloom_filter = (
+        bool(args.sqlite_bloom_filter)
+        if args.sqlite_bloom_filter is not None
+        else bool(environ.get("SQLITE_BLOOM_FILTER", False))
+    )
+    max_workers = (
+        args.workers
+        if args.workers is not None
+        else int(environ.get("MAX_WORKERS", 1))
+    )
+    profile_workers = (
+        args.profile_workers
+        if args.profile_workers is not None
+        else int(environ.get("PROFILE_WORKERS", 1))
+    )
+    chunk_days = (
+        args.chunk_days
+        if args.chunk_days is not None
+        else int(environ["CHUNK_DAYS"]) if environ.get("CHUNK_DAYS") else None
+    )
+    chunk_workers = (
+        args.chunk_workers
+        if args.chunk_workers is not None
+        else int(environ.get("CHUNK_WORKERS", 1))
+    )
+    chunk_retries = (
+        args.chunk_retries
+        if args.chunk_retries is not None
+        else int(environ.get("CHUNK_RETRIES", 0))
+    )
+    sync_overlap_days = (
+        args.overlap_days
+        if args.overlap_days is not None
+        else int(environ.get("SYNC_OVERLAP_DAYS", 1))
+    )
 
-    if not username:
-        raise ValueError("Username is required.")
+    if not profiles_file:
+        if not username:
+            raise ValueError("Username is required.")
 
-    if not password_hash:
-        raise ValueError("Password hash is required.")
+        if not password_hash:
+            raise ValueError("Password hash is required.")
 
     emails = {}
 
@@ -117,7 +413,12 @@ def load_settings() -> Settings:
         account_number, email = wallet_email.split(':')
         emails[account_number] = email
 
-    if emails:
+    if profiles_file:
+        profiles = load_profiles(profiles_file, emails)
+    else:
+        profiles = [Profile(username=username, password_hash=password_hash, wallet_emails=emails)]
+
+    if any(profile.wallet_emails for profile in profiles):
         if not smtp_host:
             raise ValueError("SMTP host is required.")
 
@@ -140,19 +441,82 @@ def load_settings() -> Settings:
     else:
         smtp_settings = None
 
-    if not emails and not save_to_csv:
+    if repository not in REPOSITORIES:
+        raise ValueError(f"Repository must be one of {', '.join(REPOSITORIES)}.")
+
+    if attachment_compression and attachment_compression not in COMPRESSION_MODES:
+        raise ValueError(f"Attachment compression must be one of {', '.join(COMPRESSION_MODES)}.")
+
+    if not export_formats or any(export_format not in EXPORTERS for export_format in export_formats):
+        raise ValueError(f"Export formats must be some of {', '.join(EXPORTERS)}.")
+
+    if skip_unchanged_balances and not only_new:
+        raise ValueError("Skipping unchanged balances requires only new transactions to be exported.")
+
+    if skip_unchanged_balances and min_transaction_age_days:
+        raise ValueError("Skipping unchanged balances can't be used with min transaction age days, "
+                         "older transactions enter the export period without changing the balance.")
+
+    if daemon and not only_new:
+        raise ValueError("Daemon mode requires only new transactions to be exported.")
+
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(f"Metrics format must be one of {', '.join(METRICS_FORMATS)}.")
+
+    if not smtp_settings and not save_to_csv:
         raise ValueError("Either wallet emails or save to CSV must be set.")
 
     return Settings(
-        username=username,
-        password_hash=password_hash,
+        profiles=profiles,
         max_transaction_age_days=max_transaction_age_days,
         min_transaction_age_days=min_transaction_age_days,
         only_new=only_new,
         db_file=db_file,
         save_to_csv=save_to_csv,
         csv_file_dir=csv_file_dir,
-        wallet_emails=emails,
         smtp_settings=smtp_settings,
         log_level=log_level,
+        repository=repository,
+        archive_dir=archive_dir,
+        max_workers=max_workers,
+        profile_workers=profile_workers,
+        chunk_days=chunk_days,
+        chunk_workers=chunk_workers,
+        chunk_retries=chunk_retries,
+        sync_overlap_days=sync_overlap_days,
+        skip_unchanged_balances=skip_unchanged_balances,
+        batch_size=batch_size,
+        pipeline_workers=pipeline_workers,
+        pipeline_queue_size=pipeline_queue_size,
+        session_cache_dir=session_cache_dir,
+        session_cache_ttl=session_cache_ttl,
+        record_dir=record_dir,
+        attachment_compression=attachment_compression,
+        export_formats=export_formats,
+        split_by_month=split_by_month,
+        render_workers=render_workers,
+        replay_dir=replay_dir,
+        stream_responses=stream_responses,
+        daemon=daemon,
+        poll_interval=poll_interval,
+        poll_jitter=poll_jitter,
+        health_host=health_host,
+        health_port=health_port,
+        metrics_file=metrics_file,
+        metrics_format=metrics_format,
+        profile_file=profile_file,
+        sqlite_settings=SQLiteSettings(
+            journal_mode=sqlite_journal_mode,
+            synchronous=sqlite_synchronous,
+            cache_size=sqlite_cache_size,
+            mmap_size=sqlite_mmap_size,
+            busy_timeout=sqlite_busy_timeout,
+            bloom_filter=sqlite_bloom_filter,
+        ),
+        http_settings=HTTPSettings(
+            connect_timeout=http_connect_timeout,
+            read_timeout=http_read_timeout,
+            retries=http_retries,
+            backoff_factor=http_backoff,
+        ),
     )
@@ -1,31 +1,495 @@
-import os
-from datetime import date, timedelta
+import random
+import signal
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from time import perf_counter
 
 from config import settings
-from src.raiffeisen_rs.api import RaiffeisenRsAPI
+from src.raiffeisen_rs.api import AccountTransactions, RaiffeisenRsAPI
+from src.raiffeisen_rs.cache import SessionCache
+from src.raiffeisen_rs.replay import record, replay
+from src.raiffeisen_rs.transport import Transport
+from src.raiffeisen_rs.utils import parse_datetime
+from src.repositories.transactions.parquet.core import Parquet
 from src.repositories.transactions.sqlite.core import SQLite
+from src.utils.compression import compress
 from src.utils.email import SMTP
+from src.utils.exporters import EXPORTERS, UNKNOWN_MONTH, ExportFile, render, render_batch, split_by_month
+from src.utils.health import HealthServer
+from src.utils.iterables import batched
 from src.utils.logger import get_logger
+from src.utils.metrics import metrics
+from src.utils.pipeline import Pipeline, StageError
+from src.utils.profiler import Profiler
+from src.utils.scheduler import Scheduler
 
 logger = get_logger(__name__, settings.log_level)
 
 
-def main():
-    logger.info("Starting export from Raiffeisen.rs")
-    logger.debug(f"Settings: {settings}")
+@dataclass
+class AccountExport:
+    account_transactions: AccountTransactions
+    filename: str
+    content: bytes | None = None
+    rows_count: int = 0
 
-    api = RaiffeisenRsAPI(
-        username=settings.username,
-        password_hash=settings.password_hash,
+    @property
+    def account(self):
+        return self.account_transactions.account
+
+
+@dataclass
+class AccountStatus:
+    interval: int
+    last_sync: datetime | None = None
+    last_error: str | None = None
+
+
+def render_async(render_pool, render_func, export_format, rows, columns) -> Future:
+    if render_pool:
+        return render_pool.submit(render_func, export_format, rows, columns)
+    future = Future()
+    future.set_result(render_func(export_format, rows, columns))
+    return future
+
+
+def write_batch(render_pool, targets, columns):
+    """Render a batch into export files, rows of formats which aren't streaming are kept until finish_files."""
+
+    futures = []
+    for export_file, rows in targets:
+        if export_file.exporter.streaming:
+            futures.append(
+                (export_file, render_async(render_pool, render_batch, export_file.exporter.name, rows, columns))
+            )
+        else:
+            export_file.rows.extend(rows)
+    for export_file, future in futures:
+        export_file.write(future.result())
+
+
+def finish_files(render_pool, export_files, columns):
+    futures = [
+        (export_file, render_async(render_pool, render, export_file.exporter.name, export_file.rows, columns))
+        for export_file in export_files
+        if not export_file.exporter.streaming
+    ]
+    for export_file, future in futures:
+        export_file.write(future.result())
+        export_file.rows = []
+    for export_file in export_files:
+        export_file.commit()
+
+
+def update_watermark(db, account_transactions):
+    # Transactions without a datetime are stored and exported, but can't move the watermark
+    last_transaction_datetime = max(
+        (
+            parse_datetime(transaction.datetime)
+            for transaction in account_transactions.transactions
+            if transaction.datetime
+        ),
+        default=None,
     )
+    if last_transaction_datetime is None:
+        logger.debug(f"No transaction datetime to save for {account_transactions.account.id}")
+        return
+    logger.debug(f"Saving last synced transaction datetime {last_transaction_datetime} "
+                 f"for {account_transactions.account.id}")
+    db.set_watermark(account_transactions.account.id, last_transaction_datetime)
+
+
+def update_balance_fingerprint(db, account):
+    if settings.skip_unchanged_balances and account.balance_fingerprint:
+        db.set_balance_fingerprint(account.id, account.balance_fingerprint)
+
+
+def save_transactions(db, account_transactions):
+    if not settings.only_new:
+        return
 
+    account_id = account_transactions.account.id
+    logger.debug(f"Saving transactions to database for {account_id}")
+    started_at = perf_counter()
+    inserted = sum(
+        db.upsert(batch)
+        for batch in batched(account_transactions.iter_rows(), settings.batch_size)
+    )
+    elapsed = perf_counter() - started_at
+    metrics.increment("db.inserted_rows", inserted)
+    logger.debug(f"Saved {inserted} transactions for {account_id} "
+                 f"({inserted / elapsed if elapsed else 0:.0f} rows/s)")
+    update_watermark(db, account_transactions)
+
+
+def get_date_range():
     start_date = date.today() - timedelta(days=settings.max_transaction_age_days)
     end_date = date.today() - timedelta(days=settings.min_transaction_age_days)
+    return start_date, end_date
+
+
+def connect(profile):
+    if settings.session_cache_dir:
+        session_cache = SessionCache(
+            cache_dir=settings.session_cache_dir,
+            username=profile.username,
+            ttl=settings.session_cache_ttl,
+        )
+    else:
+        session_cache = None
+
+    pool_size = max(settings.max_workers * settings.chunk_workers, 1)
+    transport = Transport(
+        pool_size=pool_size,
+        connect_timeout=settings.http_settings.connect_timeout,
+        read_timeout=settings.http_settings.read_timeout,
+        retries=settings.http_settings.retries,
+        backoff_factor=settings.http_settings.backoff_factor,
+    )
+    if settings.replay_dir:
+        logger.info(f"Replaying bank responses from {settings.replay_dir}")
+        replay(transport.session, settings.replay_dir)
+    elif settings.record_dir:
+        logger.info(f"Recording bank responses to {settings.record_dir}")
+        record(transport.session, settings.record_dir, pool_size=pool_size)
+
+    api = RaiffeisenRsAPI(
+        username=profile.username,
+        password_hash=profile.password_hash,
+        session_cache=session_cache,
+        transport=transport,
+        stream_rows=settings.stream_responses,
+    )
+
+    logger.debug(f"Logging in to Raiffeisen.rs API as {profile.username}")
+    api.login()
+
+    if not api.accounts or settings.skip_unchanged_balances:
+        api.update_accounts()
+    return api
+
+
+def export_accounts(profile, api, accounts, db, smtp, start_date, end_date, render_pool=None) -> list[StageError]:
+    if settings.skip_unchanged_balances:
+        changed_accounts = []
+        for account in accounts:
+            if account.balance_fingerprint and account.balance_fingerprint == db.get_balance_fingerprint(account.id):
+                logger.debug(f"Balance of {account.id} hasn't changed since the last sync, skipping")
+            else:
+                changed_accounts.append(account)
+        accounts = changed_accounts
+
+    start_dates = {}
+    if settings.only_new:
+        for account in accounts:
+            watermark = db.get_watermark(account.id)
+            if watermark is None:
+                continue
+            account_start_date = watermark.date() - timedelta(days=settings.sync_overlap_days)
+            if account_start_date > start_date:
+                start_dates[account.id] = min(account_start_date, end_date)
+                logger.debug(f"Getting transactions for {account.id} from {start_dates[account.id]}")
+
+    def fetch(account):
+        logger.debug(f"Getting transactions for {account.id}")
+        transactions = account.get_transactions(
+            start_date=start_dates.get(account.id, start_date),
+            end_date=end_date,
+            chunk_days=settings.chunk_days,
+            max_workers=settings.chunk_workers,
+            retries=settings.chunk_retries,
+        )
+        # Accounts without transactions go on as well, so their balance fingerprint is stored by the store stage
+        return AccountTransactions(account=account, transactions=transactions)
+
+    def prepare(account_transactions):
+        account = account_transactions.account
+        basename = "{from_date}_{to_date}_{account_number}_{account_currency}".format(
+            from_date=start_date.strftime("%Y-%m-%d"),
+            to_date=end_date.strftime("%Y-%m-%d"),
+            account_number=account.number,
+            account_currency=account.currency,
+        )
+        if settings.daemon:
+            # Every poll of a day exports new transactions only, the poll time keeps them from replacing each other
+            basename += datetime.now().strftime("_%H%M%S")
+
+        columns = account_transactions.columns
+        primary_exporter = EXPORTERS[settings.export_formats[0]]
+        filename = f"{basename}.{primary_exporter.extension}"
+        send_email = bool(profile.wallet_emails.get(account.id) and smtp)
+        # The email attaches the saved file of the primary format, unless there is no such file
+        render_email = send_email and (not settings.save_to_csv or settings.split_by_month)
+
+        # Export files by file path, the email attachment rendered in memory is under None
+        files = {}
+        rows_count = 0
+        undated_count = 0
+        try:
+            for batch in batched(account_transactions.iter_rows(), settings.batch_size):
+                if settings.only_new:
+                    logger.debug(f"Getting transactions from database for {account.id}")
+                    db_transaction_ids = db.find_ids(
+                        account_id=account.number,
+                        transaction_ids=[transaction["id"] for transaction in batch],
+                    )
+                    batch = [transaction for transaction in batch if transaction["id"] not in db_transaction_ids]
+                if not batch:
+                    continue
+                rows_count += len(batch)
+                undated_count += sum(1 for transaction in batch if not transaction.get("datetime"))
+
+                targets = []
+                if settings.save_to_csv:
+                    parts = split_by_month(batch) if settings.split_by_month else {None: batch}
+                    for export_format in settings.export_formats:
+                        exporter = EXPORTERS[export_format]
+                        for month, part in parts.items():
+                            if exporter.dated and month == UNKNOWN_MONTH:
+                                continue
+                            part_basename = f"{basename}_{month}" if month else basename
+                            file_path = f"{settings.csv_file_dir}/{part_basename}.{exporter.extension}"
+                            if file_path not in files:
+                                files[file_path] = ExportFile(exporter, columns, file_path)
+                            targets.append((files[file_path], part))
+                if render_email:
+                    if None not in files:
+                        files[None] = ExportFile(primary_exporter, columns)
+                    targets.append((files[None], batch))
+                with metrics.timer("export.render"):
+                    write_batch(render_pool, targets, columns)
+
+            with metrics.timer("export.render"):
+                finish_files(render_pool, list(files.values()), columns)
+        except BaseException:
+            for export_file in files.values():
+                export_file.discard()
+            raise
+
+        metrics.increment("export.rows", rows_count)
+        if not rows_count:
+            logger.debug(f"No new transactions for {account.id}")
+            return AccountExport(account_transactions=account_transactions, filename=filename)
+
+        dated_formats = [export_format for export_format in settings.export_formats if EXPORTERS[export_format].dated]
+        if undated_count and dated_formats:
+            logger.warning(
+                f"{undated_count} transactions of {account.id} have no datetime "
+                f"and are left out of {', '.join(dated_formats)} files"
+            )
+        for file_path in files:
+            if file_path:
+                logger.info(f"Saved file with transactions for {account.id} to {file_path}")
+        if not send_email:
+            content = None
+        elif render_email:
+            content = files[None].getvalue()
+        else:
+            with open(f"{settings.csv_file_dir}/{filename}", "rb") as f:
+                content = f.read()
+
+        return AccountExport(
+            account_transactions=account_transactions,
+            filename=filename,
+            content=content,
+            rows_count=rows_count,
+        )
+
+    def deliver(export):
+        account_id = export.account_transactions.account.id
+        wallet_email = profile.wallet_emails.get(account_id)
+        if not export.rows_count or not wallet_email or not smtp:
+            return export
+
+        logger.debug(f"Sending file with transactions for {account_id} via email to {wallet_email}")
+        with metrics.timer("compress"):
+            content, attachment_name = compress(export.content, export.filename, settings.attachment_compression)
+        result = smtp.send_async(
+            to=wallet_email,
+            subject=f"Raiffeisen RS transactions for {account_id} from {start_date} to {end_date}",
+            content=content,
+            filename=attachment_name,
+        ).result()
+        if not result.ok:
+            raise result.error
+        logger.info(f"Sent file with transactions for {account_id} via email to {wallet_email}")
+        return export
+
+    def store(export):
+        if not settings.only_new:
+            return
+        if export.rows_count:
+            save_transactions(db, export.account_transactions)
+        elif export.account_transactions.transactions:
+            update_watermark(db, export.account_transactions)
+        update_balance_fingerprint(db, export.account)
+
+    logger.info(f"Getting transactions for {profile.username}...")
+    pipeline = (
+        Pipeline(queue_size=settings.pipeline_queue_size)
+        .add_stage("fetch", fetch, workers=settings.max_workers)
+        .add_stage("prepare", prepare, workers=settings.pipeline_workers)
+        .add_stage("deliver", deliver, workers=settings.pipeline_workers)
+        .add_stage("store", store, workers=1)
+    )
+    errors = pipeline.run(accounts)
+    for error in errors:
+        account = getattr(error.item, "account", error.item)
+        logger.error(f"Failed to {error.stage} transactions for {account.id}: {error.error!r}")
+    return errors
+
+
+def export_profile(profile, db, smtp, start_date, end_date, render_pool=None):
+    api = connect(profile)
+    errors = export_accounts(profile, api, api.accounts, db, smtp, start_date, end_date, render_pool)
+
+    for endpoint, latency in api.transport.latency_summary().items():
+        logger.debug(f"{endpoint} latency for {profile.username}: {latency['count']} requests, "
+                     f"p50 {latency['p50']:.3f}s, p95 {latency['p95']:.3f}s, max {latency['max']:.3f}s")
+
+    if errors:
+        raise RuntimeError(f"Export failed for {len(errors)} of {len(api.accounts)} accounts")
+
 
-    logger.info(f"Exporting transactions from {start_date} to {end_date}")
+def write_metrics():
+    summary = metrics.summary()
+    for name, timer in summary["timers"].items():
+        logger.debug(f"{name}: {timer['count']} calls, {timer['total']:.3f}s total, {timer['max']:.3f}s max")
+    for name, value in summary["counters"].items():
+        logger.debug(f"{name}: {value:g}")
+    if settings.metrics_file:
+        logger.debug(f"Writing run summary to {settings.metrics_file}")
+        metrics.write(settings.metrics_file, settings.metrics_format)
+
+
+def run_daemon(db, smtp, render_pool=None):
+    """
+    Poll accounts of all profiles on a schedule until SIGTERM or SIGINT.
+    Logged in sessions, the database connection and the SMTP connection are kept between polls.
+    A profile failing to connect is reported in health and connected again every poll interval.
+    A poll in progress is finished before shutting down.
+    """
+
+    scheduler = Scheduler()
+    apis = {}
+    statuses = {}
+
+    def connect_profile(profile) -> bool:
+        status = statuses.setdefault((profile.username, None), AccountStatus(interval=settings.poll_interval))
+        try:
+            apis[profile.username] = connect(profile)
+        except Exception as error:
+            logger.exception(f"Failed to connect {profile.username}, retrying in {settings.poll_interval}s")
+            status.last_error = repr(error)
+            return False
+
+        del statuses[(profile.username, None)]
+        for account in apis[profile.username].accounts:
+            interval = profile.poll_intervals.get(account.id, settings.poll_interval)
+            statuses[(profile.username, account.id)] = AccountStatus(interval=interval)
+            scheduler.add(
+                (profile.username, account.id),
+                interval=interval,
+                jitter=settings.poll_jitter,
+                delay=random.uniform(0, settings.poll_jitter),
+            )
+        return True
+
+    for profile in settings.profiles:
+        if not connect_profile(profile):
+            scheduler.add((profile.username, None), interval=settings.poll_interval, delay=settings.poll_interval)
+    started_at = datetime.now()
+
+    def health():
+        now = datetime.now()
+        accounts = {}
+        for (username, account_id), status in statuses.items():
+            lag = (now - (status.last_sync or started_at)).total_seconds()
+            accounts[f"{username}/{account_id}" if account_id else username] = {
+                "last_sync": status.last_sync.isoformat() if status.last_sync else None,
+                "lag_seconds": round(lag),
+                "interval_seconds": status.interval,
+                "last_error": status.last_error,
+                "ok": lag <= 2 * status.interval + settings.poll_jitter,
+            }
+        return {"ok": all(account["ok"] for account in accounts.values()), "accounts": accounts}
+
+    def stop(signum, frame):
+        logger.info(f"Received {signal.Signals(signum).name}, stopping after the current poll")
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    if settings.health_port:
+        health_server = HealthServer(settings.health_host, settings.health_port, health, metrics.to_prometheus)
+        health_server.start()
+        logger.info(f"Serving /health and /metrics on {settings.health_host}:{settings.health_port}")
+    else:
+        health_server = None
+
+    logger.info(f"Polling {len(apis)} of {len(settings.profiles)} profiles every {settings.poll_interval}s by default")
+    try:
+        while due := scheduler.wait():
+            start_date, end_date = get_date_range()
+            due_accounts = defaultdict(set)
+            for username, account_id in due:
+                due_accounts[username].add(account_id)
+
+            for profile in settings.profiles:
+                if profile.username not in due_accounts:
+                    continue
+                account_ids = due_accounts[profile.username]
+                if None in account_ids:
+                    if connect_profile(profile):
+                        scheduler.remove((profile.username, None))
+                    continue
+                api = apis[profile.username]
+                try:
+                    if settings.skip_unchanged_balances:
+                        api.update_accounts()
+                    accounts = [account for account in api.accounts if account.id in account_ids]
+                    errors = export_accounts(profile, api, accounts, db, smtp, start_date, end_date, render_pool)
+                except Exception as error:
+                    logger.exception(f"Export failed for {profile.username}")
+                    failed = {account_id: repr(error) for account_id in account_ids}
+                else:
+                    failed = {getattr(error.item, "account", error.item).id: repr(error.error) for error in errors}
+
+                synced_at = datetime.now()
+                for account_id in account_ids:
+                    status = statuses[(profile.username, account_id)]
+                    status.last_error = failed.get(account_id)
+                    if not status.last_error:
+                        status.last_sync = synced_at
+
+            if smtp:
+                deliveries = smtp.results()
+                if deliveries:
+                    logger.info(f"Sent {sum(result.ok for result in deliveries)} of {len(deliveries)} emails")
+    finally:
+        if health_server:
+            health_server.close()
+
+
+def main():
+    logger.info("Starting export from Raiffeisen.rs")
+    profiler = Profiler() if settings.profile_file else None
+    if profiler:
+        profiler.start()
+    logger.debug(f"Settings: {settings}")
+
+    start_date, end_date = get_date_range()
+
+    if settings.daemon:
+        logger.info(f"Exporting transactions from the last {settings.max_transaction_age_days} days on schedule")
+    else:
+        logger.info(f"Exporting transactions from {start_date} to {end_date}")
 
     if settings.save_to_csv:
-        logger.info(f"CSV files will be saved to {settings.csv_file_dir}")
+        logger.info(f"{', '.join(settings.export_formats)} files will be saved to {settings.csv_file_dir}")
 
     if settings.smtp_settings:
         smtp = SMTP(
@@ -42,75 +506,68 @@ def main():
 
     if settings.only_new:
         logger.info("Only new transactions will be exported")
-        logger.debug(f"Connecting to database {settings.db_file}")
-        db = SQLite(settings.db_file)
+        if settings.repository == "parquet":
+            logger.debug(f"Opening Parquet archive {settings.archive_dir}")
+            db = Parquet(settings.archive_dir)
+        else:
+            logger.debug(f"Connecting to database {settings.db_file}")
+            db = SQLite(
+                settings.db_file,
+                journal_mode=settings.sqlite_settings.journal_mode,
+                synchronous=settings.sqlite_settings.synchronous,
+                cache_size=settings.sqlite_settings.cache_size,
+                mmap_size=settings.sqlite_settings.mmap_size,
+                busy_timeout=settings.sqlite_settings.busy_timeout,
+                bloom_filter=settings.sqlite_settings.bloom_filter,
+            )
     else:
         logger.info("All transactions will be exported")
         db = None
 
-    try:
-        logger.debug(f"Logging in to Raiffeisen.rs API as {settings.username}")
-        api.login()
-        logger.info(f"Getting transactions...")
-        account_transactions_groups = api.get_transactions(
-            start_date=start_date,
-            end_date=end_date,
-        )
-
-        for account_transactions in account_transactions_groups:
-            if not account_transactions.transactions:
-                continue
-
-            account = account_transactions.account
-            transactions = account_transactions.to_df()
-
-            if settings.only_new:
-                transaction_ids = transactions["id"].tolist()
-                logger.debug(f"Getting transactions from database for {account.number}-{account.currency}")
-                db_transactions = db.find(
-                    account_id=account.number,
-                    transaction_ids=transaction_ids,
-                )
-                if not db_transactions.empty:
-                    transactions = transactions[~transactions["id"].isin(db_transactions["id"].tolist())]
-                    if transactions.empty:
-                        logger.debug(f"No new transactions for {account.number}-{account.currency}")
-                        continue
-
-            filename = "{from_date}_{to_date}_{account_number}_{account_currency}.csv".format(
-                from_date=start_date.strftime("%Y-%m-%d"),
-                to_date=end_date.strftime("%Y-%m-%d"),
-                account_number=account.number,
-                account_currency=account.currency,
-            )
-            file_path = f"{settings.csv_file_dir}/{filename}"
-            account_id = f"{account.number}-{account.currency}"
-            logger.debug(f"Writing CSV file with transactions for {account_id} to {file_path}")
-            transactions.to_csv(file_path, index=False)
-
-            wallet_email = settings.wallet_emails.get(account_id)
-            if wallet_email and smtp:
-                logger.debug(f"Sending CSV file with transactions for {account_id} via email to {wallet_email}")
-                smtp.send(
-                    to=wallet_email,
-                    subject=f"Raiffeisen RS transactions for {account_id} from {start_date} to {end_date}",
-                    attached_file=file_path,
-                )
-                logger.info(f"Sent CSV file with transactions for {account_id} via email to {wallet_email}")
-
-            if not settings.save_to_csv:
-                logger.debug(f"Deleting CSV file with transactions for {account_id}")
-                os.remove(file_path)
-            else:
-                logger.info(f"Saved CSV file with transactions for {account_id} to {file_path}")
+    if settings.render_workers:
+        render_pool = ProcessPoolExecutor(max_workers=settings.render_workers)
+        # Start the workers while this is the only thread, so forked workers don't inherit locks held by others
+        render_pool.submit(int).result()
+    else:
+        render_pool = None
 
-            if settings.only_new:
-                logger.debug(f"Saving transactions to database for {account_id}")
-                db.add(transactions)
+    failed_profiles = []
+    try:
+        if settings.daemon:
+            run_daemon(db, smtp, render_pool)
+            return
+        with ThreadPoolExecutor(max_workers=settings.profile_workers) as executor:
+            futures = [
+                (profile, executor.submit(export_profile, profile, db, smtp, start_date, end_date, render_pool))
+                for profile in settings.profiles
+            ]
+            for profile, future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"Export failed for {profile.username}")
+                    failed_profiles.append(profile.username)
+                else:
+                    logger.info(f"Export succeeded for {profile.username}")
     finally:
+        if render_pool:
+            render_pool.shutdown()
+        if smtp:
+            deliveries = smtp.results()
+            smtp.close()
+            if deliveries:
+                logger.info(f"Sent {sum(result.ok for result in deliveries)} of {len(deliveries)} emails")
         if db:
             logger.debug(f"Closing database connection")
             db.close()
+        if profiler:
+            profiler.stop()
+            logger.info(f"Saving profile to {settings.profile_file}")
+            profiler.dump(settings.profile_file)
+        write_metrics()
+
+    if failed_profiles:
+        raise SystemExit(f"Export failed for {', '.join(failed_profiles)}")
 
     logger.info("Finished export from Raiffeisen.rs")
 
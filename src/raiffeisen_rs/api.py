@@ -1,11 +1,20 @@
-import pandas as pd
+import hashlib
+import json
+
 import requests
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from operator import attrgetter
+from threading import RLock
+from typing import Iterator
 
-from src.raiffeisen_rs.utils import decode_response, parse_date
+from src.raiffeisen_rs.schema import normalize_df
+from src.raiffeisen_rs.transport import Transport
+from src.raiffeisen_rs.utils import decode_response, iter_response_rows, parse_date, split_date_range, to_date
+from src.utils.metrics import metrics
 
 
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     id: str
     currency_code: str
@@ -20,45 +29,61 @@ class Transaction:
     balance: str
 
     def to_dict(self):
-        return self.__dict__
+        return {name: getattr(self, name) for name in self.__slots__}
 
     @classmethod
     def from_list(cls, transaction):
-        kwargs = {
-            'id': transaction[11],
-            'currency_code': transaction[1],
-            'currency': transaction[2],
-            'datetime': transaction[3],
-            'title': transaction[5],
-            'debit': transaction[7],
-            'credit': transaction[8],
-            'balance': transaction[9],
-            'additional_info': transaction[10],
-            'transaction_type': transaction[12],
-            'description': transaction[13],
-        }
-        return cls(**kwargs)
+        return cls(
+            transaction[11],
+            transaction[1],
+            transaction[2],
+            transaction[3],
+            transaction[5],
+            transaction[7],
+            transaction[8],
+            transaction[10],
+            transaction[12],
+            transaction[13],
+            transaction[9],
+        )
 
 
 class Account:
     """Account class."""
 
-    def __init__(self, api_obj, number, currency, currency_code, product_core_id):
+    def __init__(
+            self,
+            api_obj,
+            number,
+            currency,
+            currency_code,
+            product_core_id,
+            balance=None,
+            balance_fingerprint=None,
+    ):
         self.api_obj = api_obj
         self.number = number
         self.currency = currency
         self.currency_code = currency_code
         self.product_core_id = product_core_id
+        self.balance = balance
+        self.balance_fingerprint = balance_fingerprint
 
     def __repr__(self):
         return f'Account({self.number}, {self.currency})'
 
+    @property
+    def id(self):
+        return f'{self.number}-{self.currency}'
+
     def to_dict(self):
         return {
             'number': self.number,
             'currency': self.currency,
             'currency_code': self.currency_code,
             'product_core_id': self.product_core_id,
+            'balance': self.balance,
+            'balance_fingerprint': self.balance_fingerprint,
         }
 
     def get_transactions(
@@ -67,9 +92,14 @@ class Account:
             end_date=None,
             from_amount=None,
             to_amount=None,
+            chunk_days=None,
+            max_workers=1,
+            retries=0,
     ) -> list[Transaction]:
         """
         Get account transactions.
+        Long date ranges can be split into chunks of chunk_days days, which are fetched
+        concurrently and merged by transaction id. A failed chunk is retried on its own.
         Args:
             start_date (str | int | datetime | date): Start date. Default is None.
                 Supported format is %d.%m.%Y or ISO format.
@@ -77,11 +107,58 @@ class Account:
                 Supported format is %d.%m.%Y or ISO format.
             from_amount (float): Filter transactions by min amount. Default is None.
             to_amount (float): Filter transactions by max amount. Default is None.
+            chunk_days (int): Max number of days requested at once. Default is None (no chunking).
+            max_workers (int): Max number of chunks fetched at the same time. Default is 1.
+            retries (int): Number of retries for a failed chunk. Default is 0.
         Returns:
             list[Transaction]: List of transactions.
         """
 
-        self.api_obj.session.headers['Referer'] = 'https://rol.raiffeisenbank.rs/Retail/user/accounts'
+        start_date = to_date(start_date)
+        end_date = to_date(end_date)
+        if not chunk_days or start_date is None or end_date is None:
+            chunks = [(start_date, end_date)]
+        else:
+            chunks = split_date_range(start_date, end_date, chunk_days)
+        if not chunks:
+            return []
+
+        def get_chunk_transactions(chunk):
+            chunk_start_date, chunk_end_date = chunk
+            for attempt in range(retries + 1):
+                try:
+                    return self._get_transactions(
+                        start_date=chunk_start_date,
+                        end_date=chunk_end_date,
+                        from_amount=from_amount,
+                        to_amount=to_amount,
+                    )
+                except (requests.RequestException, ValueError):
+                    if attempt == retries:
+                        raise
+
+        if len(chunks) == 1:
+            return get_chunk_transactions(chunks[0])
+
+        if max_workers <= 1:
+            chunks_transactions = [get_chunk_transactions(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+                chunks_transactions = list(executor.map(get_chunk_transactions, chunks))
+
+        transactions = {}
+        for chunk_transactions in chunks_transactions:
+            for transaction in chunk_transactions:
+                transactions.setdefault(transaction.id, transaction)
+        return list(transactions.values())
+
+    def _get_transactions(
+            self,
+            start_date=None,
+            end_date=None,
+            from_amount=None,
+            to_amount=None,
+    ) -> list[Transaction]:
         filters = {
             'CurrencyCodeNumeric': self.currency_code,
             'FromDate': parse_date(start_date),
@@ -90,21 +167,28 @@ class Account:
             'ToAmount': to_amount,
         }
 
-        response = self.api_obj.session.post(
+        response = self.api_obj.post(
             'https://rol.raiffeisenbank.rs/Retail/Protected/Services/DataService.svc/GetTransactionalAccountTurnover',
             json={
                 'accountNumber': self.number,
                 'productCoreID': self.product_core_id,
                 'filterParam': filters,
                 'gridName': 'RetailAccountTurnoverTransactionDomesticPreviewMasterDetail-S',
-            }
+            },
+            stream=self.api_obj.stream_rows,
         )
-        response.raise_for_status()
-        data = decode_response(response)
-        return [
-            Transaction.from_list(transaction)
-            for transaction in data[0][1]
-        ] if data and len(data[0]) > 1 else []
+        with metrics.timer('api.decode'):
+            if self.api_obj.stream_rows:
+                transactions = [Transaction.from_list(transaction) for transaction in iter_response_rows(response)]
+                metrics.increment('api.transactions', len(transactions))
+                return transactions
+            data = decode_response(response)
+            transactions = [
+                Transaction.from_list(transaction)
+                for transaction in data[0][1]
+            ] if data and len(data[0]) > 1 else []
+        metrics.increment('api.transactions', len(transactions))
+        return transactions
 
 
 @dataclass
@@ -118,21 +202,48 @@ class AccountTransactions:
             'transactions': [transaction.to_dict() for transaction in self.transactions],
         }
 
-    def to_df(self):
-        df = pd.DataFrame([transaction.to_dict() for transaction in self.transactions])
-        df['account'] = self.account.number
-        return df
+    @property
+    def columns(self) -> list[str]:
+        return [field.name for field in fields(Transaction)] + ['account']
+
+    def iter_rows(self) -> Iterator[dict]:
+        """Yield transactions one by one as dicts tagged with the account number, same as raw to_df rows."""
+        for transaction in self.transactions:
+            yield {**transaction.to_dict(), 'account': self.account.number}
+
+    def to_df(self, normalize=True):
+        """
+        Get transactions as a DataFrame.
+        Args:
+            normalize (bool): Parse datetime and amount columns into datetime64 and float64 columns.
+                Default is True. Otherwise values are kept as sent by the bank.
+        Returns:
+            pd.DataFrame: Transactions tagged with the account number.
+        """
+
+        import pandas as pd
+
+        with metrics.timer('api.to_df'):
+            names = Transaction.__slots__
+            columns = list(zip(*map(attrgetter(*names), self.transactions))) or [[] for _ in names]
+            df = pd.DataFrame(dict(zip(names, columns)))
+            df['account'] = self.account.number
+            return normalize_df(df) if normalize else df
 
 
 class RaiffeisenRsAPI:
     """Raiffeisen.rs Online Banking API."""
 
-    def __init__(self, username, password_hash):
+    def __init__(self, username, password_hash, session_cache=None, transport=None, stream_rows=False):
         self.username = username
         self.password_hash = password_hash
+        self.stream_rows = stream_rows
+        self.session_cache = session_cache
+        self.transport = transport or Transport()
         self.accounts = []
         self.request_token = None
-        self.session = requests.Session()
+        self._login_lock = RLock()
+        self.session = self.transport.session
         self.session.headers = {
             'User-Agent': 'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) '
                           'Gecko/20100101 Firefox/110.0',
@@ -150,38 +261,77 @@ class RaiffeisenRsAPI:
             'X-Requested-With': 'XMLHttpRequest',
         }
 
-    def login(self):
-        """Login to Raiffeisen.rs Online Banking."""
+    def login(self, use_cache=True):
+        """
+        Login to Raiffeisen.rs Online Banking.
+        A session restored from the session cache is validated by the first request made with it.
+        Args:
+            use_cache (bool): Restore the session from the session cache if possible. Default is True.
+        """
 
-        self.session.headers['Referer'] = 'https://rol.raiffeisenbank.rs/Retail/Home/Login'
-        response = self.session.post(
-            'https://rol.raiffeisenbank.rs/Retail/Protected/Services/RetailLoginService.svc/LoginFont',
-            json={
-                'username': self.username,
-                'password': self.password_hash,
-                'sessionID': 1,
-            }
-        )
+        with self._login_lock, metrics.timer('api.login'):
+            if use_cache and self.session_cache and self._restore_session():
+                metrics.increment('api.restored_sessions')
+                return
+
+            response = self.transport.post(
+                'https://rol.raiffeisenbank.rs/Retail/Protected/Services/RetailLoginService.svc/LoginFont',
+                idempotent=False,
+                headers={'Referer': 'https://rol.raiffeisenbank.rs/Retail/Home/Login'},
+                json={
+                    'username': self.username,
+                    'password': self.password_hash,
+                    'sessionID': 1,
+                }
+            )
+            response.raise_for_status()
+            data = decode_response(response)
+            self.request_token = data['RequestToken']
+            self.session.headers['X-Holos-RequestToken'] = self.request_token
+            self._save_session()
+
+    def post(self, url, json, referer='https://rol.raiffeisenbank.rs/Retail/user/accounts', stream=False):
+        """
+        Send a request within the logged in session.
+        A session rejected by the bank, e.g. restored from the cache or expired in a long-running process,
+        is replaced by a fresh login once.
+        Args:
+            url (str): Service URL.
+            json (dict): Request payload.
+            referer (str): Referer header. Default is the accounts page.
+            stream (bool): Don't download the response body up front, e.g. to stream-parse it. Default is False.
+        Returns:
+            requests.Response: Successful response.
+        """
+
+        request_token = self.request_token
+        response = self.transport.post(url, headers={'Referer': referer}, json=json, stream=stream)
+        if response.status_code in (401, 403) and request_token:
+            response.close()
+            with self._login_lock:
+                if self.request_token == request_token:
+                    if self.session_cache:
+                        self.session_cache.clear()
+                    self.login(use_cache=False)
+            response = self.transport.post(url, headers={'Referer': referer}, json=json, stream=stream)
         response.raise_for_status()
-        data = decode_response(response)
-        self.request_token = data['RequestToken']
-        self.session.headers['X-Holos-RequestToken'] = self.request_token
+        return response
 
     def get_accounts(self) -> list[dict]:
         """
         Get accounts from server.
+        Every account carries a fingerprint of its whole balance row, which changes
+        with the balance and any other field the bank updates on account movements.
         Returns:
             list[dict]: List of accounts.
         """
 
-        self.session.headers['Referer'] = 'https://rol.raiffeisenbank.rs/Retail/user/accounts'
-        response = self.session.post(
+        response = self.post(
             'https://rol.raiffeisenbank.rs/Retail/Protected/Services/DataService.svc/GetAllAccountBalance',
             json={
                 'gridName': 'RetailAccountBalancePreviewFlat-L',
             }
         )
-        response.raise_for_status()
         data = decode_response(response)
         accounts = [
             {
@@ -189,6 +339,10 @@ class RaiffeisenRsAPI:
                 "currency": item[3],
                 "currency_code": item[14],
                 "product_core_id": item[13],
+                "balance": item[4],
+                "balance_fingerprint": hashlib.sha256(
+                    json.dumps(item, sort_keys=True, default=str).encode()
+                ).hexdigest(),
             }
             for item in data
         ]
@@ -200,6 +354,10 @@ class RaiffeisenRsAPI:
         """
 
         accounts = self.get_accounts()
+        self._set_accounts(accounts)
+        self._save_session()
+
+    def _set_accounts(self, accounts):
         self.accounts = [
             Account(
                 self,
@@ -207,19 +365,52 @@ class RaiffeisenRsAPI:
                 currency=account['currency'],
                 currency_code=account['currency_code'],
                 product_core_id=account['product_core_id'],
+                balance=account.get('balance'),
+                balance_fingerprint=account.get('balance_fingerprint'),
             )
             for account in accounts
         ]
 
+    def _restore_session(self) -> bool:
+        data = self.session_cache.load()
+        if not data:
+            return False
+        for cookie in data['cookies']:
+            self.session.cookies.set(**cookie)
+        self.request_token = data['request_token']
+        self.session.headers['X-Holos-RequestToken'] = self.request_token
+        if data['accounts']:
+            self._set_accounts(data['accounts'])
+        return True
+
+    def _save_session(self):
+        if not self.session_cache:
+            return
+        self.session_cache.save(
+            cookies=[
+                {'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path}
+                for cookie in self.session.cookies
+            ],
+            request_token=self.request_token,
+            accounts=[account.to_dict() for account in self.accounts],
+        )
+
     def get_transactions(
             self,
             start_date=None,
             end_date=None,
             from_amount=None,
             to_amount=None,
+            max_workers=1,
+            chunk_days=None,
+            chunk_workers=1,
+            chunk_retries=0,
+            start_dates=None,
     ) -> list[AccountTransactions]:
         """
         Get transactions from all accounts.
+        Accounts are fetched concurrently over the shared logged in session when max_workers > 1,
+        results are returned in the same order as accounts.
         Args:
             start_date (str | int | datetime | date): Start date. Default is None.
                 Supported format is %d.%m.%Y or ISO format.
@@ -227,6 +418,12 @@ class RaiffeisenRsAPI:
                 Supported format is %d.%m.%Y or ISO format.
             from_amount (float): Filter transactions by min amount. Default is None.
             to_amount (float): Filter transactions by max amount. Default is None.
+            max_workers (int): Max number of accounts fetched at the same time. Default is 1.
+            chunk_days (int): Max number of days requested at once per account. Default is None (no chunking).
+            chunk_workers (int): Max number of chunks fetched at the same time per account. Default is 1.
+            chunk_retries (int): Number of retries for a failed chunk. Default is 0.
+            start_dates (dict[str, str | int | datetime | date]): Start date overrides by account id
+                (number-currency), e.g. to continue from the last synced transaction. Default is None.
         Returns:
             list[AccountTransactions]: List of AccountTransactions.
         """
@@ -234,18 +431,25 @@ class RaiffeisenRsAPI:
         if not self.accounts:
             self.update_accounts()
 
-        transactions = []
-        for account in self.accounts:
+        start_dates = start_dates or {}
+
+        def get_account_transactions(account):
             account_transactions_raw = account.get_transactions(
-                start_date=start_date,
+                start_date=start_dates.get(account.id, start_date),
                 end_date=end_date,
                 from_amount=from_amount,
                 to_amount=to_amount,
+                chunk_days=chunk_days,
+                max_workers=chunk_workers,
+                retries=chunk_retries,
             )
-            account_transactions = AccountTransactions(
+            return AccountTransactions(
                 account=account,
                 transactions=account_transactions_raw,
             )
-            transactions.append(account_transactions)
 
-        return transactions
+        if max_workers <= 1 or len(self.accounts) <= 1:
+            return [get_account_transactions(account) for account in self.accounts]
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(self.accounts))) as executor:
+            return list(executor.map(get_account_transactions, self.accounts))
@@ -0,0 +1,46 @@
+import json
+import os
+import time
+from hashlib import sha256
+from pathlib import Path
+
+
+class SessionCache:
+    """On-disk cache of a logged in session: cookies, request token and accounts."""
+
+    def __init__(self, cache_dir: str, username: str, ttl: int = 600):
+        self.path = Path(cache_dir) / f'{sha256(username.encode()).hexdigest()}.json'
+        self.ttl = ttl
+
+    def load(self) -> dict | None:
+        """
+        Load cached session.
+        Returns:
+            dict | None: Cached session or None if it is missing, broken or expired.
+        """
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - data.get('saved_at', 0) > self.ttl:
+            return None
+        return data
+
+    def save(self, cookies: list[dict], request_token: str, accounts: list[dict]):
+        data = {
+            'saved_at': time.time(),
+            'cookies': cookies,
+            'request_token': request_token,
+            'accounts': accounts,
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,149 @@
+import codecs
+import json
+import random
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from pathlib import Path
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+BOM = codecs.BOM_UTF8
+
+
+def fixture_name(request: requests.PreparedRequest, dated: bool = True) -> str:
+    """
+    Get fixture file name for a bank request.
+    Turnover requests are keyed by account, currency and date range, so every chunk of a chunked
+    request has its own fixture. Without dated, by account and currency only, as generate_fixtures
+    writes them. All other requests are keyed by endpoint only.
+    """
+
+    endpoint = request.path_url.rsplit('/', 1)[-1]
+    if endpoint == 'GetTransactionalAccountTurnover':
+        body = json.loads(request.body)
+        filters = body['filterParam']
+        name = f"{endpoint}_{body['accountNumber']}_{filters['CurrencyCodeNumeric']}"
+        if dated:
+            name += f"_{_fixture_date(filters.get('FromDate'))}_{_fixture_date(filters.get('ToDate'))}"
+        return f'{name}.json'
+    return f'{endpoint}.json'
+
+
+def _fixture_date(value: str | None) -> str:
+    return datetime.strptime(value, '%d.%m.%Y').date().isoformat() if value else 'any'
+
+
+class RecordingAdapter(HTTPAdapter):
+    """HTTP adapter saving raw response bodies of successful requests to a fixture directory."""
+
+    def __init__(self, fixture_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.fixture_dir = Path(fixture_dir)
+        self.fixture_dir.mkdir(parents=True, exist_ok=True)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if response.ok:
+            (self.fixture_dir / fixture_name(request)).write_bytes(response.content)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """HTTP adapter answering requests from a fixture directory instead of the bank."""
+
+    def __init__(self, fixture_dir):
+        super().__init__()
+        self.fixture_dir = Path(fixture_dir)
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        fixture_path = self.fixture_dir / fixture_name(request)
+        if not fixture_path.exists():
+            # Generated turnover fixtures answer requests of any date range
+            fixture_path = self.fixture_dir / fixture_name(request, dated=False)
+        if fixture_path.exists():
+            response.status_code = 200
+            response.raw = BytesIO(fixture_path.read_bytes())
+        else:
+            response.status_code = 404
+            response.raw = BytesIO()
+        return response
+
+    def close(self):
+        pass
+
+
+def record(session: requests.Session, fixture_dir, pool_size=10):
+    """Record bank responses of the session to fixture_dir."""
+    session.mount('https://', RecordingAdapter(fixture_dir, pool_connections=pool_size, pool_maxsize=pool_size))
+
+
+def replay(session: requests.Session, fixture_dir):
+    """Answer bank requests of the session from fixture_dir."""
+    session.mount('https://', ReplayAdapter(fixture_dir))
+
+
+def generate_fixtures(fixture_dir, accounts=3, transactions=100, days=30, seed=0):
+    """
+    Generate synthetic fixtures for accounts × transactions turnover rows.
+    Bodies are BOM-prefixed like the real bank responses.
+    Args:
+        fixture_dir (str | Path): Directory to write fixtures to.
+        accounts (int): Number of accounts. Default is 3.
+        transactions (int): Number of transactions per account. Default is 100.
+        days (int): Transactions are spread over the last days. Default is 30.
+        seed (int): Random seed. Default is 0.
+    """
+
+    fixture_dir = Path(fixture_dir)
+    fixture_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    def write(name, data):
+        (fixture_dir / name).write_bytes(BOM + json.dumps(data, ensure_ascii=False).encode())
+
+    write('LoginFont.json', {'RequestToken': 'replay-token'})
+
+    balance_rows = []
+    for account_index in range(accounts):
+        row = [None] * 15
+        row[1] = f'265000000{account_index:08d}'
+        row[3] = 'RSD'
+        row[4] = 0.0
+        row[13] = str(1000 + account_index)
+        row[14] = '941'
+        balance_rows.append(row)
+    write('GetAllAccountBalance.json', balance_rows)
+
+    end = datetime.combine(date.today(), datetime.min.time())
+    for account_row in balance_rows:
+        account_number, currency_code = account_row[1], account_row[14]
+        balance = 0.0
+        rows = []
+        for index in range(transactions):
+            debit = round(rng.uniform(1, 10000), 2) if rng.random() < 0.8 else 0.0
+            credit = round(rng.uniform(1, 100000), 2) if not debit else 0.0
+            balance = round(balance + credit - debit, 2)
+            transaction_datetime = end - timedelta(seconds=rng.randrange(days * 24 * 3600))
+            rows.append([
+                index,
+                currency_code,
+                'RSD',
+                transaction_datetime.strftime('%d.%m.%Y %H:%M:%S'),
+                None,
+                f'Payment {index}',
+                None,
+                debit,
+                credit,
+                balance,
+                f'Reference {rng.randrange(10 ** 9)}',
+                f'{account_number}-{index}',
+                rng.choice(('Card payment', 'Transfer', 'Fee', 'Salary')),
+                f'Synthetic transaction {index}',
+            ])
+        write(f'GetTransactionalAccountTurnover_{account_number}_{currency_code}.json', [[None, rows]])
@@ -0,0 +1,86 @@
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from src.raiffeisen_rs.utils import BANK_DATETIME_FORMATS, parse_amount, parse_datetime
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+TRANSACTION_SCHEMA = {
+    'id': str,
+    'currency_code': str,
+    'currency': str,
+    'datetime': datetime,
+    'title': str,
+    'debit': float,
+    'credit': float,
+    'additional_info': str,
+    'transaction_type': str,
+    'description': str,
+    'balance': float,
+}
+DATETIME_COLUMNS = tuple(column for column, column_type in TRANSACTION_SCHEMA.items() if column_type is datetime)
+AMOUNT_COLUMNS = tuple(column for column, column_type in TRANSACTION_SCHEMA.items() if column_type is float)
+
+
+def normalize_transaction(transaction: dict) -> dict:
+    """
+    Parse bank formatted datetime and amount values of a transaction dict.
+    Args:
+        transaction (dict): Transaction as sent by the bank, e.g. from AccountTransactions.iter_rows.
+    Returns:
+        dict: Transaction with datetime values and float amounts, empty values are None.
+    """
+
+    normalized = dict(transaction)
+    for column in DATETIME_COLUMNS:
+        value = transaction.get(column)
+        normalized[column] = None if value in (None, '') else parse_datetime(value)
+    for column in AMOUNT_COLUMNS:
+        normalized[column] = parse_amount(transaction.get(column))
+    return normalized
+
+
+def normalize_df(df: 'pd.DataFrame') -> 'pd.DataFrame':
+    """
+    Parse bank formatted datetime and amount columns of a transactions DataFrame.
+    Known formats are parsed column-wise, only values they don't cover are parsed one by one.
+    Args:
+        df (pd.DataFrame): Transactions as sent by the bank.
+    Returns:
+        pd.DataFrame: Same DataFrame with datetime64 and float64 columns.
+    """
+
+    for column in DATETIME_COLUMNS:
+        if column in df:
+            df[column] = _to_datetime(df[column])
+    for column in AMOUNT_COLUMNS:
+        if column in df:
+            df[column] = _to_amount(df[column])
+    return df
+
+
+def _to_datetime(series: 'pd.Series') -> 'pd.Series':
+    import pandas as pd
+
+    present = series.notna() & (series != '')
+    result = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    for datetime_format in BANK_DATETIME_FORMATS:
+        missing = present & result.isna()
+        if not missing.any():
+            return result
+        result[missing] = pd.to_datetime(series[missing], format=datetime_format, errors='coerce')
+    missing = present & result.isna()
+    if missing.any():
+        result[missing] = pd.to_datetime(series[missing].map(parse_datetime))
+    return result
+
+
+def _to_amount(series: 'pd.Series') -> 'pd.Series':
+    import pandas as pd
+
+    result = pd.to_numeric(series, errors='coerce').astype('float64')
+    missing = series.notna() & result.isna()
+    if missing.any():
+        result[missing] = series[missing].map(parse_amount).astype('float64')
+    return result
@@ -0,0 +1,106 @@
+import random
+import time
+from collections import defaultdict
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.utils.metrics import metrics
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class Transport:
+    """HTTP transport with a sized connection pool, timeouts, retries with backoff and latency tracking."""
+
+    def __init__(
+            self,
+            pool_size=10,
+            connect_timeout=10.0,
+            read_timeout=120.0,
+            retries=3,
+            backoff_factor=0.5,
+            max_backoff=30.0,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._latencies = defaultdict(list)
+        self._latencies_lock = Lock()
+
+    def post(self, url, idempotent=True, **kwargs) -> requests.Response:
+        """
+        Send POST request.
+        Idempotent requests are retried on connection errors, timeouts and transient status codes
+        with exponential backoff and full jitter.
+        Args:
+            url (str): Request URL.
+            idempotent (bool): Whether the request can be safely retried. Default is True.
+            **kwargs: Arguments passed to requests.Session.post.
+        Returns:
+            requests.Response: Response of the last attempt.
+        """
+
+        retries = self.retries if idempotent else 0
+        endpoint = url.rsplit('/', 1)[-1]
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.increment('http.retries')
+            metrics.increment('http.requests')
+            started_at = time.perf_counter()
+            try:
+                response = self.session.post(url, timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                self._sleep(attempt)
+                continue
+            finally:
+                self._record_latency(endpoint, time.perf_counter() - started_at)
+
+            if response.status_code in RETRY_STATUS_CODES and attempt < retries:
+                # Release the pooled connection of a streamed response before retrying
+                response.close()
+                self._sleep(attempt, response.headers.get('Retry-After'))
+                continue
+            if not kwargs.get('stream'):
+                metrics.increment('http.response_bytes', len(response.content))
+            return response
+
+    def latency_summary(self) -> dict[str, dict[str, float]]:
+        """
+        Get latency statistics per endpoint.
+        Returns:
+            dict[str, dict[str, float]]: Request count and p50, p95 and max latency in seconds by endpoint.
+        """
+
+        with self._latencies_lock:
+            latencies = {endpoint: sorted(values) for endpoint, values in self._latencies.items()}
+        return {
+            endpoint: {
+                'count': len(values),
+                'p50': values[int((len(values) - 1) * 0.5)],
+                'p95': values[int((len(values) - 1) * 0.95)],
+                'max': values[-1],
+            }
+            for endpoint, values in latencies.items()
+        }
+
+    def _record_latency(self, endpoint, latency):
+        with self._latencies_lock:
+            self._latencies[endpoint].append(latency)
+        metrics.observe(f'http.{endpoint}', latency)
+
+    def _sleep(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            delay = min(float(retry_after), self.max_backoff)
+        else:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+        time.sleep(delay)
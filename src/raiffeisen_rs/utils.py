@@ -1,11 +1,108 @@
+import codecs
 import json
-from datetime import date, datetime
+import re
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BANK_DATETIME_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
 
 
 def decode_response(response):
-    text = response.text
-    text_without_bom = text.encode().decode('utf-8-sig')
-    return json.loads(text_without_bom)
+    """
+    Decode a JSON response body, the bank prefixes it with a UTF-8 BOM.
+    The body bytes are parsed directly, without charset detection and text copies,
+    with orjson when it is installed.
+    """
+
+    content = response.content
+    if orjson:
+        view = memoryview(content)
+        return orjson.loads(view[len(codecs.BOM_UTF8):] if content.startswith(codecs.BOM_UTF8) else view)
+    # json.loads detects the encoding of bytes and skips the UTF-8 BOM
+    return json.loads(content)
+
+
+def import_ijson():
+    try:
+        import ijson
+    except ImportError as error:
+        raise ImportError("Streaming responses requires ijson, install it with 'pip install ijson'") from error
+    return ijson
+
+
+def iter_response_rows(response, chunk_size=64 * 1024) -> Iterator:
+    """
+    Stream-parse data[0][1] of a grid response, e.g. turnover rows, without decoding the whole body at once.
+    Args:
+        response (requests.Response): Response, preferably requested with stream=True.
+        chunk_size (int): Number of body bytes parsed at once. Default is 64 KiB.
+    Returns:
+        Iterator: Rows one by one.
+    """
+
+    ijson = import_ijson()
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    # Number of elements seen so far in every open array, rows are elements of [0][1]
+    path = []
+    builder = None
+    builder_depth = 0
+    head = b''
+
+    def handle(event, value):
+        nonlocal builder, builder_depth
+        if builder is not None:
+            builder.event(event, value)
+            if event in ('start_array', 'start_map'):
+                builder_depth += 1
+            elif event in ('end_array', 'end_map'):
+                builder_depth -= 1
+            if not builder_depth:
+                row, builder = builder.value, None
+                return row, True
+            return None, False
+        if event in ('end_array', 'end_map'):
+            path.pop()
+            return None, False
+        if path and event != 'map_key':
+            path[-1] += 1
+        if len(path) == 3 and path[0] == 1 and path[1] == 2:
+            if event in ('start_array', 'start_map'):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                builder_depth = 1
+                return None, False
+            return value, True
+        if event in ('start_array', 'start_map'):
+            path.append(0)
+        return None, False
+
+    def drain():
+        for _, event, value in events:
+            row, ready = handle(event, value)
+            if ready:
+                yield row
+        del events[:]
+
+    for chunk in response.iter_content(chunk_size):
+        if head is not None:
+            head += chunk
+            if len(head) < len(codecs.BOM_UTF8):
+                continue
+            chunk = head[len(codecs.BOM_UTF8):] if head.startswith(codecs.BOM_UTF8) else head
+            head = None
+        if chunk:
+            parser.send(chunk)
+            yield from drain()
+    if head:
+        parser.send(head)
+    parser.close()
+    yield from drain()
 
 
 def parse_date(dt: str | datetime | date | int) -> str | None:
@@ -28,3 +125,79 @@ def parse_date(dt: str | datetime | date | int) -> str | None:
             return None
         case _:
             raise TypeError(f'Unsupported type {type(dt)}')
+
+
+def to_date(dt: str | datetime | date | int | None) -> date | None:
+    if dt is None:
+        return None
+    return datetime.strptime(parse_date(dt), '%d.%m.%Y').date()
+
+
+def split_date_range(start_date: date, end_date: date, chunk_days: int) -> list[tuple[date, date]]:
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+def parse_datetime(dt: str | datetime | date | None) -> datetime | None:
+    match dt:
+        case datetime():
+            return dt
+        case date():
+            return datetime.combine(dt, datetime.min.time())
+        case str():
+            json_date = re.fullmatch(r'/Date\((-?\d+)([+-]\d{4})?\)/', dt)
+            if json_date:
+                return datetime.fromtimestamp(int(json_date.group(1)) / 1000, tz=timezone.utc).replace(tzinfo=None)
+            try:
+                return datetime.fromisoformat(dt)
+            except ValueError:
+                pass
+            for datetime_format in BANK_DATETIME_FORMATS:
+                try:
+                    return datetime.strptime(dt, datetime_format)
+                except ValueError:
+                    pass
+            raise ValueError(f'Unsupported datetime format {dt}')
+        case None:
+            return None
+        case _:
+            raise TypeError(f'Unsupported type {type(dt)}')
+
+
+def parse_end_datetime(dt: str | datetime | date | None) -> datetime | None:
+    """Parse the inclusive end of a range, a date without time means the end of that day."""
+    end_datetime = parse_datetime(dt)
+    if isinstance(dt, datetime) or end_datetime is None:
+        return end_datetime
+    if isinstance(dt, date) or len(dt.strip()) <= 10:
+        return datetime.combine(end_datetime.date(), time.max)
+    return end_datetime
+
+
+def parse_amount(amount: str | float | int | None) -> float | None:
+    match amount:
+        case None:
+            return None
+        case bool():
+            raise TypeError(f'Unsupported type {type(amount)}')
+        case int() | float():
+            return float(amount)
+        case str():
+            value = re.sub(r'\s', '', amount)
+            if not value:
+                return None
+            if value.rfind(',') > value.rfind('.'):
+                value = value.replace('.', '').replace(',', '.')
+            else:
+                value = value.replace(',', '')
+            try:
+                return float(value)
+            except ValueError:
+                raise ValueError(f'Unsupported amount format {amount}')
+        case _:
+            raise TypeError(f'Unsupported type {type(amount)}')
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import TYPE_CHECKING, Iterable
 
-from pandas import DataFrame
+if TYPE_CHECKING:
+    from pandas import DataFrame
 
 
 class BaseTransactionRepository(ABC):
@@ -12,9 +15,58 @@ class BaseTransactionRepository(ABC):
             currency: str | None = None,
             start_date: str | None = None,
             end_date: str | None = None,
-    ) -> DataFrame:
+    ) -> 'DataFrame':
         pass
 
     @abstractmethod
-    def add(self, transactions: DataFrame):
+    def find_ids(self, account_id: str, transaction_ids: list[str]) -> set[str]:
+        pass
+
+    @abstractmethod
+    def add(self, transactions: 'DataFrame') -> int:
+        pass
+
+    @abstractmethod
+    def upsert(self, transactions: Iterable[dict]) -> int:
+        pass
+
+    @abstractmethod
+    def get_watermark(self, account_id: str) -> datetime | None:
+        pass
+
+    @abstractmethod
+    def set_watermark(self, account_id: str, last_transaction_datetime: datetime):
+        pass
+
+    @abstractmethod
+    def daily_totals(
+            self,
+            account_id: str | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'DataFrame':
+        """
+        Get debit, credit and transaction count per account, currency and day, with the closing balance
+        sent by the bank and the running total of credit - debit since the first stored day.
+        """
+        pass
+
+    @abstractmethod
+    def transaction_type_totals(
+            self,
+            account_id: str | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'DataFrame':
+        """Get debit, credit and transaction count per account, currency and transaction type."""
+        pass
+
+    @abstractmethod
+    def get_balance_fingerprint(self, account_id: str) -> str | None:
+        pass
+
+    @abstractmethod
+    def set_balance_fingerprint(self, account_id: str, balance_fingerprint: str):
         pass
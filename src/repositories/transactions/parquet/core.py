@@ -0,0 +1,354 @@
+import fcntl
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from threading import RLock
+from typing import TYPE_CHECKING, Iterable
+
+from src.raiffeisen_rs.schema import normalize_transaction
+from src.raiffeisen_rs.utils import parse_datetime, parse_end_datetime
+from src.repositories.transactions.base import BaseTransactionRepository
+from src.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+STRING_COLUMNS = (
+    'id',
+    'currency_code',
+    'currency',
+    'datetime',
+    'title',
+    'additional_info',
+    'transaction_type',
+    'description',
+)
+FLOAT_COLUMNS = ('debit', 'credit', 'balance')
+PARTITION_COLUMNS = ('account', 'month')
+UNKNOWN_MONTH = 'unknown'
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Parquet repository requires pyarrow, install it with 'pip install pyarrow'") from error
+    return pyarrow, pyarrow.dataset, pyarrow.parquet
+
+
+class Parquet(BaseTransactionRepository):
+    """
+    Columnar transaction archive.
+    Transactions are stored in compressed Parquet files partitioned by account and month
+    (archive_dir/account=<number>/month=<YYYY-MM>/data.parquet), transactions without a datetime
+    go to the month=unknown partition. Reads are memory-mapped and filters are pushed down
+    to partitions and row groups.
+    New rows are buffered and every partition is rewritten once per flush, which happens on
+    set_watermark, find, close or when buffer_size rows are pending. Ids of every partition are
+    read once and cached until the partition file changes.
+    Partitions and state files are rewritten under an exclusive lock of their .lock file, so several
+    processes can write to the same archive.
+    """
+
+    def __init__(self, archive_dir: str, compression: str = 'zstd', buffer_size: int = 100_000):
+        self.archive_dir = Path(archive_dir)
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.sync_state_path = self.archive_dir / '_sync_state.json'
+        self.balance_state_path = self.archive_dir / '_balance_state.json'
+        self.lock = RLock()
+        self.pa, self.ds, self.pq = import_pyarrow()
+        self.schema = self.pa.schema(
+            [(column, self.pa.string()) for column in STRING_COLUMNS]
+            + [(column, self.pa.float64()) for column in FLOAT_COLUMNS]
+            + [('timestamp', self.pa.timestamp('ms'))]
+        )
+        self.partitioning = self.ds.partitioning(
+            self.pa.schema([(column, self.pa.string()) for column in PARTITION_COLUMNS]),
+            flavor='hive',
+        )
+        self._pending: dict[tuple[str, str], list[dict]] = defaultdict(list)
+        self._pending_count = 0
+        self._partition_ids: dict[tuple[str, str], tuple[int | None, set[str]]] = {}
+
+    def close(self):
+        self.flush()
+
+    def flush(self):
+        """Write buffered rows to their partitions."""
+
+        with self.lock:
+            for (account, month), rows in self._pending.items():
+                self._merge_partition(account, month, rows)
+            self._pending.clear()
+            self._pending_count = 0
+
+    @metrics.timed('parquet.find')
+    def find(
+            self,
+            account_id: str | None = None,
+            transaction_ids: list[str] | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'pd.DataFrame':
+        import pandas as pd
+
+        start_datetime = parse_datetime(start_date)
+        end_datetime = parse_end_datetime(end_date)
+        filters = []
+        if account_id:
+            filters.append(('account', '=', str(account_id)))
+        if transaction_ids:
+            filters.append(('id', 'in', [str(transaction_id) for transaction_id in transaction_ids]))
+        if currency:
+            filters.append(('currency', '=', currency))
+        if start_datetime:
+            filters.append(('month', '>=', start_datetime.strftime('%Y-%m')))
+            filters.append(('timestamp', '>=', start_datetime))
+        if end_datetime:
+            filters.append(('month', '<=', end_datetime.strftime('%Y-%m')))
+            filters.append(('timestamp', '<=', end_datetime))
+
+        with self.lock:
+            self.flush()
+            if not any(self.archive_dir.glob('account=*/month=*/*.parquet')):
+                return pd.DataFrame()
+            table = self.pq.read_table(
+                self.archive_dir,
+                filters=filters or None,
+                partitioning=self.partitioning,
+                memory_map=True,
+            )
+        columns = [column for column in table.column_names if column not in ('month', 'datetime')]
+        table = table.select(columns)
+        return table.rename_columns(
+            ['datetime' if column == 'timestamp' else column for column in table.column_names]
+        ).to_pandas()
+
+    @metrics.timed('parquet.find_ids')
+    def find_ids(self, account_id: str, transaction_ids: list[str]) -> set[str]:
+        if not transaction_ids:
+            return set()
+        account_id = str(account_id)
+        with self.lock:
+            months = {
+                path.parent.name.removeprefix('month=')
+                for path in (self.archive_dir / f'account={account_id}').glob('month=*/data.parquet')
+            }
+            months.update(month for account, month in self._pending if account == account_id)
+            known_ids = [self._known_ids(account_id, month) for month in sorted(months)]
+        return {
+            str(transaction_id)
+            for transaction_id in transaction_ids
+            if any(str(transaction_id) in ids for ids in known_ids)
+        }
+
+    def add(self, transactions: 'pd.DataFrame') -> int:
+        return self.upsert(transactions.to_dict('records'))
+
+    @metrics.timed('parquet.upsert')
+    def upsert(self, transactions: Iterable[dict]) -> int:
+        """Buffer transactions not stored yet, see flush. Returns the number of new transactions."""
+
+        partitions = defaultdict(list)
+        for transaction in transactions:
+            transaction = normalize_transaction(transaction)
+            timestamp = transaction['datetime']
+            row = {
+                column: None if transaction.get(column) is None else str(transaction[column])
+                for column in STRING_COLUMNS
+            }
+            row.update({column: transaction.get(column) for column in FLOAT_COLUMNS})
+            row['datetime'] = timestamp.isoformat() if timestamp else None
+            row['timestamp'] = timestamp
+            month = timestamp.strftime('%Y-%m') if timestamp else UNKNOWN_MONTH
+            partitions[(str(transaction['account']), month)].append(row)
+
+        inserted = 0
+        with self.lock:
+            for (account, month), rows in partitions.items():
+                known_ids = self._known_ids(account, month)
+                for row in rows:
+                    if row['id'] not in known_ids:
+                        known_ids.add(row['id'])
+                        self._pending[(account, month)].append(row)
+                        inserted += 1
+            self._pending_count += inserted
+            if self._pending_count >= self.buffer_size:
+                self.flush()
+        return inserted
+
+    def get_watermark(self, account_id: str) -> datetime | None:
+        with self.lock:
+            value = self._read_state(self.sync_state_path).get(account_id)
+        return datetime.fromisoformat(value) if value else None
+
+    def set_watermark(self, account_id: str, last_transaction_datetime: datetime):
+        with self.lock:
+            # The watermark must not get ahead of the stored transactions
+            self.flush()
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            with self._file_lock(self.sync_state_path):
+                sync_state = self._read_state(self.sync_state_path)
+                current = sync_state.get(account_id)
+                if current and datetime.fromisoformat(current) >= last_transaction_datetime:
+                    return
+                sync_state[account_id] = last_transaction_datetime.isoformat()
+                self._write_atomic(self.sync_state_path, json.dumps(sync_state).encode())
+
+    def _partition_path(self, account: str, month: str) -> Path:
+        return self.archive_dir / f'account={account}' / f'month={month}' / 'data.parquet'
+
+    def _known_ids(self, account: str, month: str) -> set[str]:
+        """Get ids of a partition including buffered rows, read again only when the partition file changed."""
+
+        partition_path = self._partition_path(account, month)
+        mtime = partition_path.stat().st_mtime_ns if partition_path.exists() else None
+        cached = self._partition_ids.get((account, month))
+        if cached is None or cached[0] != mtime:
+            ids = set()
+            if mtime is not None:
+                ids.update(self.pq.read_table(partition_path, columns=['id'], memory_map=True).column('id').to_pylist())
+            ids.update(row['id'] for row in self._pending.get((account, month), ()))
+            cached = (mtime, ids)
+            self._partition_ids[(account, month)] = cached
+        return cached[1]
+
+    def _merge_partition(self, account: str, month: str, rows: list[dict]) -> int:
+        partition_path = self._partition_path(account, month)
+        partition_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._file_lock(partition_path):
+            # Read under the lock, so rows written by another process since the ids were cached are kept
+            existing = self.pq.read_table(partition_path, memory_map=True) if partition_path.exists() else None
+            known_ids = set(existing.column('id').to_pylist()) if existing is not None else set()
+            new_rows = []
+            for row in rows:
+                if row['id'] not in known_ids:
+                    known_ids.add(row['id'])
+                    new_rows.append(row)
+            if not new_rows:
+                return 0
+
+            table = self.pa.Table.from_pylist(new_rows, schema=self.schema)
+            if existing is not None:
+                table = self.pa.concat_tables([existing, table])
+            table = table.sort_by('timestamp')
+
+            tmp_path = partition_path.with_name(f'.{partition_path.name}.tmp')
+            self.pq.write_table(table, tmp_path, compression=self.compression)
+            os.replace(tmp_path, partition_path)
+            self._partition_ids[(account, month)] = (partition_path.stat().st_mtime_ns, known_ids)
+            return len(new_rows)
+
+    @metrics.timed('parquet.daily_totals')
+    def daily_totals(
+            self,
+            account_id: str | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'pd.DataFrame':
+        """Totals are computed from the stored transactions, the running total always starts at the first day."""
+
+        transactions = self.find(account_id=account_id, currency=currency)
+        if transactions.empty:
+            return transactions
+
+        transactions = self._summary_frame(transactions).sort_values('datetime', kind='stable')
+        keys = ['account', 'currency', 'day']
+        totals = transactions.groupby(keys, sort=True).agg(
+            debit=('debit', 'sum'),
+            credit=('credit', 'sum'),
+            count=('id', 'size'),
+            closing_balance=('balance', 'last'),
+        ).reset_index()
+        totals['running_total'] = (
+            (totals['credit'] - totals['debit']).groupby([totals['account'], totals['currency']]).cumsum()
+        )
+        return self._filter_days(totals, start_date, end_date).reset_index(drop=True)
+
+    @metrics.timed('parquet.transaction_type_totals')
+    def transaction_type_totals(
+            self,
+            account_id: str | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'pd.DataFrame':
+        transactions = self.find(account_id=account_id, currency=currency, start_date=start_date, end_date=end_date)
+        if transactions.empty:
+            return transactions
+
+        transactions = self._summary_frame(transactions)
+        transactions['transaction_type'] = transactions['transaction_type'].fillna('')
+        return transactions.groupby(['account', 'currency', 'transaction_type'], sort=True).agg(
+            debit=('debit', 'sum'),
+            credit=('credit', 'sum'),
+            count=('id', 'size'),
+        ).reset_index()
+
+    @staticmethod
+    def _summary_frame(transactions: 'pd.DataFrame') -> 'pd.DataFrame':
+        transactions = transactions[transactions['datetime'].notna()]
+        return transactions.assign(
+            account=transactions['account'].astype(str),
+            currency=transactions['currency'].fillna(''),
+            day=transactions['datetime'].dt.strftime('%Y-%m-%d'),
+            debit=transactions['debit'].fillna(0.0),
+            credit=transactions['credit'].fillna(0.0),
+        )
+
+    @staticmethod
+    def _filter_days(totals: 'pd.DataFrame', start_date: str | None, end_date: str | None) -> 'pd.DataFrame':
+        start_datetime = parse_datetime(start_date)
+        end_datetime = parse_end_datetime(end_date)
+        if start_datetime:
+            totals = totals[totals['day'] >= start_datetime.date().isoformat()]
+        if end_datetime:
+            totals = totals[totals['day'] <= end_datetime.date().isoformat()]
+        return totals
+
+    def get_balance_fingerprint(self, account_id: str) -> str | None:
+        with self.lock:
+            return self._read_state(self.balance_state_path).get(account_id)
+
+    def set_balance_fingerprint(self, account_id: str, balance_fingerprint: str):
+        with self.lock:
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            with self._file_lock(self.balance_state_path):
+                balance_state = self._read_state(self.balance_state_path)
+                balance_state[account_id] = balance_fingerprint
+                self._write_atomic(self.balance_state_path, json.dumps(balance_state).encode())
+
+    @staticmethod
+    def _read_state(path: Path) -> dict[str, str]:
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    @contextmanager
+    def _file_lock(path: Path):
+        """Hold an exclusive lock of the .lock file next to a file, blocking until other processes release it."""
+
+        with open(path.with_name(f'.{path.name}.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_atomic(path: Path, content: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
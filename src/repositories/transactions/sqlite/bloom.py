@@ -0,0 +1,65 @@
+import math
+import os
+import struct
+from hashlib import blake2b
+from pathlib import Path
+from typing import Iterable
+
+HEADER = struct.Struct('<4sQIQQ')
+MAGIC = b'BLM1'
+
+
+class BloomFilter:
+    """
+    Bloom filter over transaction ids.
+    A miss means the id is definitely not stored, a hit means it may be stored.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001, count: int = 0, bits: bytearray | None = None):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.count = count
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, items: Iterable[str]):
+        for item in items:
+            self.add(item)
+
+    @property
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.capacity, int(self.error_rate * 1_000_000), self.count, self.size))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'BloomFilter | None':
+        try:
+            with open(path, 'rb') as f:
+                magic, capacity, error_rate, count, size = HEADER.unpack(f.read(HEADER.size))
+                bits = bytearray(f.read())
+        except (OSError, struct.error):
+            return None
+        bloom_filter = cls(capacity, error_rate / 1_000_000, count, bits)
+        if magic != MAGIC or bloom_filter.size != size or len(bits) != (size + 7) // 8:
+            return None
+        return bloom_filter
+
+    def _positions(self, item: str) -> Iterable[int]:
+        digest = blake2b(str(item).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + index * second) % self.size for index in range(self.hash_count))
@@ -1,8 +1,46 @@
-import pandas as pd
-from pandas.errors import DatabaseError
-from sqlite3 import connect
+from collections import defaultdict
+from datetime import datetime
+from functools import wraps
+from hashlib import sha1
+from pathlib import Path
+from sqlite3 import IntegrityError, connect
+from threading import RLock
+from typing import TYPE_CHECKING, Iterable
 
+from src.raiffeisen_rs.schema import normalize_transaction
+from src.raiffeisen_rs.utils import parse_datetime, parse_end_datetime
 from src.repositories.transactions.base import BaseTransactionRepository
+from src.repositories.transactions.sqlite.bloom import BloomFilter
+from src.utils.metrics import metrics
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+TRANSACTION_COLUMNS = (
+    ('id', 'TEXT NOT NULL'),
+    ('account', 'TEXT NOT NULL'),
+    ('currency_code', 'TEXT'),
+    ('currency', 'TEXT'),
+    ('datetime', 'TEXT'),
+    ('title', 'TEXT'),
+    ('debit', 'REAL'),
+    ('credit', 'REAL'),
+    ('additional_info', 'TEXT'),
+    ('transaction_type', 'TEXT'),
+    ('description', 'TEXT'),
+    ('balance', 'REAL'),
+)
+# Bumped when TRANSACTION_COLUMNS change, stored in PRAGMA user_version.
+# 1: ISO datetime, REAL balance.
+SCHEMA_VERSION = 1
+
+
+def synchronized(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class SQLite(BaseTransactionRepository):
@@ -10,28 +48,75 @@ class SQLite(BaseTransactionRepository):
             self,
             db_path: str,
             transaction_table_name: str = 'transactions',
+            sync_state_table_name: str = 'sync_state',
+            balance_state_table_name: str = 'balance_state',
+            journal_mode: str | None = 'WAL',
+            synchronous: str | None = 'NORMAL',
+            cache_size: int | None = None,
+            mmap_size: int | None = None,
+            busy_timeout: int = 5000,
+            bloom_filter: bool = False,
+            bloom_error_rate: float = 0.001,
     ):
         self.db_path = db_path
+        self.pragmas = {
+            'journal_mode': journal_mode,
+            'synchronous': synchronous,
+            'cache_size': cache_size,
+            'mmap_size': mmap_size,
+            'busy_timeout': busy_timeout,
+        }
         self.transaction_table_name = transaction_table_name
+        self.sync_state_table_name = sync_state_table_name
+        self.balance_state_table_name = balance_state_table_name
+        self.ids_table_name = f'{transaction_table_name}_lookup_ids'
+        self.daily_table_name = f'{transaction_table_name}_daily'
+        self.daily_types_table_name = f'{transaction_table_name}_daily_types'
         self.connection = None
+        self.lock = RLock()
+        self._indexed = False
+        self.bloom_filter = bloom_filter
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom_dir = Path(f'{db_path}.bloom')
+        self._bloom_filters = {}
+        self._dirty_bloom_filters = set()
+        self._verified_bloom_filters = set()
+        self._data_version = None
 
     def __enter__(self):
-        self.connection = connect(self.db_path)
+        self.connection = self._connect()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.connection.commit()
+        self._save_bloom_filters()
         self.connection.close()
 
+    @synchronized
     def get_connection(self):
         if not self.connection:
-            self.connection = connect(self.db_path)
+            self.connection = self._connect()
         return self.connection
 
+    def _connect(self):
+        connection = connect(
+            self.db_path,
+            timeout=self.pragmas['busy_timeout'] / 1000,
+            check_same_thread=False,
+        )
+        for name, value in self.pragmas.items():
+            if value is not None:
+                connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    @synchronized
     def close(self):
+        self._save_bloom_filters()
         if self.connection:
             self.connection.close()
 
+    @synchronized
+    @metrics.timed('sqlite.find')
     def find(
             self,
             account_id: str | None = None,
@@ -39,33 +124,437 @@ class SQLite(BaseTransactionRepository):
             currency: str | None = None,
             start_date: str | None = None,
             end_date: str | None = None,
-    ) -> pd.DataFrame:
-        query = f"SELECT * FROM {self.transaction_table_name}"
+    ) -> 'pd.DataFrame':
+        import pandas as pd
+        from pandas.errors import DatabaseError
+
+        connection = self.get_connection()
+        if not self._table_exists(connection):
+            return pd.DataFrame()
+
+        start_datetime = parse_datetime(start_date)
+        end_datetime = parse_end_datetime(end_date)
+        query = f"SELECT t.* FROM {self.transaction_table_name} t"
         where = []
-        if account_id:
-            where.append(f"account = '{account_id}'")
+        params = []
         if transaction_ids:
-            where.append(f"id IN {tuple(transaction_ids)}") \
-                if len(transaction_ids) > 1 \
-                else where.append(f"id = '{transaction_ids[0]}'")
+            self._fill_ids_table(connection, transaction_ids)
+            # An IN subquery keeps the index search per id, a join would scan all rows of the account
+            where.append(f"t.id IN (SELECT id FROM temp.{self.ids_table_name})")
+        if account_id:
+            where.append("t.account = ?")
+            params.append(account_id)
         if currency:
-            where.append(f"currency = '{currency}'")
-        if start_date:
-            where.append(f"datetime >= '{start_date}'")
-        if end_date:
-            where.append(f"datetime <= '{end_date}'")
+            where.append("t.currency = ?")
+            params.append(currency)
+        if start_datetime:
+            where.append("t.datetime >= ?")
+            params.append(start_datetime.isoformat())
+        if end_datetime:
+            where.append("t.datetime <= ?")
+            params.append(end_datetime.isoformat())
         if where:
             query += f" WHERE {' AND '.join(where)}"
         try:
-            df = pd.read_sql_query(query, self.get_connection())
+            df = pd.read_sql_query(query, connection, params=params, parse_dates=['datetime'])
         except DatabaseError:
             df = pd.DataFrame()
         return df
 
-    def add(self, transactions: pd.DataFrame):
-        transactions.to_sql(
-            self.transaction_table_name,
-            self.get_connection(),
-            if_exists='append',
-            index=False,
+    @synchronized
+    @metrics.timed('sqlite.find_ids')
+    def find_ids(self, account_id: str, transaction_ids: list[str]) -> set[str]:
+        connection = self.get_connection()
+        if not transaction_ids or not self._table_exists(connection):
+            return set()
+
+        if self.bloom_filter:
+            bloom_filter = self._get_bloom_filter(connection, account_id)
+            transaction_ids = [transaction_id for transaction_id in transaction_ids if transaction_id in bloom_filter]
+            if not transaction_ids:
+                return set()
+
+        self._fill_ids_table(connection, transaction_ids)
+        rows = connection.execute(
+            f"SELECT t.id FROM {self.transaction_table_name} t "
+            f"WHERE t.account = ? AND t.id IN (SELECT id FROM temp.{self.ids_table_name})",
+            (account_id,),
+        )
+        return {row[0] for row in rows}
+
+    def add(self, transactions: 'pd.DataFrame') -> int:
+        return self.upsert(transactions.astype(object).where(transactions.notna(), None).to_dict('records'))
+
+    @synchronized
+    @metrics.timed('sqlite.upsert')
+    def upsert(self, transactions: Iterable[dict]) -> int:
+        connection = self.get_connection()
+        self._create_table(connection)
+        columns = ', '.join(column for column, _ in TRANSACTION_COLUMNS)
+        placeholders = ', '.join('?' for _ in TRANSACTION_COLUMNS)
+        query = (
+            f"INSERT INTO {self.transaction_table_name} ({columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT DO NOTHING"
+        )
+        rows = (self._to_row(transaction) for transaction in transactions)
+        if not self.bloom_filter:
+            with connection:
+                return connection.executemany(query, rows).rowcount
+
+        accounts_rows = defaultdict(list)
+        for row in rows:
+            accounts_rows[row[1]].append(row)
+        bloom_filters = {account: self._get_bloom_filter(connection, account) for account in accounts_rows}
+        inserted = 0
+        with connection:
+            for account, account_rows in accounts_rows.items():
+                account_inserted = connection.executemany(query, account_rows).rowcount
+                bloom_filters[account].update(row[0] for row in account_rows)
+                bloom_filters[account].count += account_inserted
+                inserted += account_inserted
+        for account, bloom_filter in bloom_filters.items():
+            self._dirty_bloom_filters.add(account)
+            if bloom_filter.full:
+                self._build_bloom_filter(connection, account)
+        return inserted
+
+    @synchronized
+    @metrics.timed('sqlite.daily_totals')
+    def daily_totals(
+            self,
+            account_id: str | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'pd.DataFrame':
+        import pandas as pd
+
+        connection = self.get_connection()
+        if not self._table_exists(connection):
+            return pd.DataFrame()
+
+        where, params = self._summary_filters(account_id, currency)
+        day_where, day_params = self._summary_day_filters(start_date, end_date)
+        query = (
+            f"SELECT * FROM ("
+            f"SELECT account, currency, day, debit, credit, count, closing_balance, "
+            f"SUM(credit - debit) OVER (PARTITION BY account, currency ORDER BY day) AS running_total "
+            f"FROM {self.daily_table_name}{where})"
+            f"{day_where} ORDER BY account, currency, day"
+        )
+        return pd.read_sql_query(query, connection, params=params + day_params)
+
+    @synchronized
+    @metrics.timed('sqlite.transaction_type_totals')
+    def transaction_type_totals(
+            self,
+            account_id: str | None = None,
+            currency: str | None = None,
+            start_date: str | None = None,
+            end_date: str | None = None,
+    ) -> 'pd.DataFrame':
+        import pandas as pd
+
+        connection = self.get_connection()
+        if not self._table_exists(connection):
+            return pd.DataFrame()
+
+        where, params = self._summary_filters(account_id, currency, start_date, end_date)
+        query = (
+            f"SELECT account, currency, transaction_type, "
+            f"SUM(debit) AS debit, SUM(credit) AS credit, SUM(count) AS count "
+            f"FROM {self.daily_types_table_name}{where} "
+            f"GROUP BY account, currency, transaction_type ORDER BY account, currency, transaction_type"
+        )
+        return pd.read_sql_query(query, connection, params=params)
+
+    def _summary_filters(self, account_id=None, currency=None, start_date=None, end_date=None):
+        where = []
+        params = []
+        if account_id:
+            where.append("account = ?")
+            params.append(account_id)
+        if currency:
+            where.append("currency = ?")
+            params.append(currency)
+        day_where, day_params = self._summary_day_filters(start_date, end_date)
+        if day_where:
+            where.append(day_where.removeprefix(" WHERE "))
+            params.extend(day_params)
+        return (f" WHERE {' AND '.join(where)}" if where else ""), params
+
+    @staticmethod
+    def _summary_day_filters(start_date=None, end_date=None):
+        start_datetime = parse_datetime(start_date)
+        end_datetime = parse_end_datetime(end_date)
+        where = []
+        params = []
+        if start_datetime:
+            where.append("day >= ?")
+            params.append(start_datetime.date().isoformat())
+        if end_datetime:
+            where.append("day <= ?")
+            params.append(end_datetime.date().isoformat())
+        return (f" WHERE {' AND '.join(where)}" if where else ""), params
+
+    @staticmethod
+    def _to_row(transaction: dict) -> tuple:
+        transaction = normalize_transaction(transaction)
+        return tuple(
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in (transaction.get(column) for column, _ in TRANSACTION_COLUMNS)
+        )
+
+    def _table_exists(self, connection) -> bool:
+        if self._indexed:
+            return True
+        row = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (self.transaction_table_name,),
+        ).fetchone()
+        if row:
+            self._create_indexes(connection)
+        return bool(row)
+
+    def _create_table(self, connection):
+        if self._indexed:
+            return
+        if not self._table_exists(connection):
+            with connection:
+                self._create_transaction_table(connection, self.transaction_table_name)
+                connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._create_indexes(connection)
+
+    @staticmethod
+    def _create_transaction_table(connection, table_name: str):
+        columns = ', '.join(f"{column} {column_type}" for column, column_type in TRANSACTION_COLUMNS)
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})")
+
+    def _migrate(self, connection):
+        """Rewrite a table created with an older schema, e.g. with bank formatted datetime strings."""
+
+        if connection.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        old_table_name = f'{self.transaction_table_name}_old'
+        columns = ', '.join(column for column, _ in TRANSACTION_COLUMNS)
+        placeholders = ', '.join('?' for _ in TRANSACTION_COLUMNS)
+        with connection:
+            connection.execute(f"DROP INDEX IF EXISTS {self.transaction_table_name}_account_id_idx")
+            connection.execute(f"ALTER TABLE {self.transaction_table_name} RENAME TO {old_table_name}")
+            self._create_transaction_table(connection, self.transaction_table_name)
+            rows = connection.execute(f"SELECT {columns} FROM {old_table_name}")
+            connection.executemany(
+                f"INSERT INTO {self.transaction_table_name} ({columns}) VALUES ({placeholders})",
+                (self._to_row(dict(zip((column for column, _ in TRANSACTION_COLUMNS), row))) for row in rows),
+            )
+            connection.execute(f"DROP TABLE {old_table_name}")
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _create_indexes(self, connection):
+        if self._indexed:
+            return
+        self._migrate(connection)
+        index_query = (
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {self.transaction_table_name}_account_id_idx "
+            f"ON {self.transaction_table_name} (account, id)"
+        )
+        with connection:
+            try:
+                connection.execute(index_query)
+            except IntegrityError:
+                connection.execute(
+                    f"DELETE FROM {self.transaction_table_name} WHERE rowid NOT IN ("
+                    f"SELECT MIN(rowid) FROM {self.transaction_table_name} GROUP BY account, id)"
+                )
+                connection.execute(index_query)
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.transaction_table_name}_account_datetime_idx "
+                f"ON {self.transaction_table_name} (account, datetime)"
+            )
+        self._create_summary_tables(connection)
+        self._indexed = True
+
+    def _create_summary_tables(self, connection):
+        """
+        Create daily and daily per transaction type totals, kept up to date by a trigger on every inserted
+        transaction and filled from the stored transactions when created.
+        The closing balance is the balance of the last transaction of the day, taken along MAX(datetime).
+        """
+
+        row = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+            (f'{self.transaction_table_name}_summary_insert',),
+        ).fetchone()
+        if row:
+            return
+
+        day = "substr({table}.datetime, 1, 10)"
+        with connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.daily_table_name} ("
+                f"account TEXT NOT NULL, currency TEXT NOT NULL, day TEXT NOT NULL, "
+                f"debit REAL NOT NULL, credit REAL NOT NULL, count INTEGER NOT NULL, "
+                f"last_datetime TEXT, closing_balance REAL, "
+                f"PRIMARY KEY (account, currency, day))"
+            )
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.daily_types_table_name} ("
+                f"account TEXT NOT NULL, currency TEXT NOT NULL, day TEXT NOT NULL, transaction_type TEXT NOT NULL, "
+                f"debit REAL NOT NULL, credit REAL NOT NULL, count INTEGER NOT NULL, "
+                f"PRIMARY KEY (account, currency, day, transaction_type))"
+            )
+            connection.execute(f"DELETE FROM {self.daily_table_name}")
+            connection.execute(f"DELETE FROM {self.daily_types_table_name}")
+            connection.execute(
+                f"INSERT INTO {self.daily_table_name} "
+                f"SELECT t.account, COALESCE(t.currency, ''), {day.format(table='t')}, "
+                f"TOTAL(t.debit), TOTAL(t.credit), COUNT(*), MAX(t.datetime), t.balance "
+                f"FROM {self.transaction_table_name} t WHERE t.datetime IS NOT NULL "
+                f"GROUP BY t.account, COALESCE(t.currency, ''), {day.format(table='t')}"
+            )
+            connection.execute(
+                f"INSERT INTO {self.daily_types_table_name} "
+                f"SELECT t.account, COALESCE(t.currency, ''), {day.format(table='t')}, "
+                f"COALESCE(t.transaction_type, ''), TOTAL(t.debit), TOTAL(t.credit), COUNT(*) "
+                f"FROM {self.transaction_table_name} t WHERE t.datetime IS NOT NULL "
+                f"GROUP BY t.account, COALESCE(t.currency, ''), {day.format(table='t')}, "
+                f"COALESCE(t.transaction_type, '')"
+            )
+            connection.execute(
+                f"CREATE TRIGGER {self.transaction_table_name}_summary_insert "
+                f"AFTER INSERT ON {self.transaction_table_name} WHEN NEW.datetime IS NOT NULL BEGIN "
+                f"INSERT INTO {self.daily_table_name} "
+                f"(account, currency, day, debit, credit, count, last_datetime, closing_balance) "
+                f"VALUES (NEW.account, COALESCE(NEW.currency, ''), {day.format(table='NEW')}, "
+                f"COALESCE(NEW.debit, 0), COALESCE(NEW.credit, 0), 1, NEW.datetime, NEW.balance) "
+                f"ON CONFLICT (account, currency, day) DO UPDATE SET "
+                f"debit = debit + excluded.debit, credit = credit + excluded.credit, count = count + 1, "
+                f"closing_balance = CASE WHEN excluded.last_datetime >= last_datetime "
+                f"THEN excluded.closing_balance ELSE closing_balance END, "
+                f"last_datetime = MAX(last_datetime, excluded.last_datetime); "
+                f"INSERT INTO {self.daily_types_table_name} "
+                f"(account, currency, day, transaction_type, debit, credit, count) "
+                f"VALUES (NEW.account, COALESCE(NEW.currency, ''), {day.format(table='NEW')}, "
+                f"COALESCE(NEW.transaction_type, ''), COALESCE(NEW.debit, 0), COALESCE(NEW.credit, 0), 1) "
+                f"ON CONFLICT (account, currency, day, transaction_type) DO UPDATE SET "
+                f"debit = debit + excluded.debit, credit = credit + excluded.credit, count = count + 1; "
+                f"END"
+            )
+
+    def _fill_ids_table(self, connection, transaction_ids: list[str]):
+        # Commit right away, an open transaction would pin the read snapshot and block later writes
+        with connection:
+            connection.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.ids_table_name} (id TEXT PRIMARY KEY)")
+            connection.execute(f"DELETE FROM temp.{self.ids_table_name}")
+            connection.executemany(
+                f"INSERT OR IGNORE INTO temp.{self.ids_table_name} (id) VALUES (?)",
+                ((transaction_id,) for transaction_id in transaction_ids),
+            )
+
+    def _get_bloom_filter(self, connection, account_id: str) -> BloomFilter:
+        """
+        Get the Bloom filter of the account ids, loaded from disk on first use.
+        A filter whose count doesn't match the table (e.g. rows added by another process
+        or a crash before the filter was saved) is rebuilt from the table. Filters are checked
+        again whenever PRAGMA data_version shows a commit made by another connection.
+        """
+
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._verified_bloom_filters.clear()
+        if account_id in self._verified_bloom_filters:
+            return self._bloom_filters[account_id]
+
+        bloom_filter = self._bloom_filters.get(account_id) or BloomFilter.load(self._bloom_filter_path(account_id))
+        if bloom_filter is None or bloom_filter.count != self._count(connection, account_id):
+            bloom_filter = self._build_bloom_filter(connection, account_id)
+        self._bloom_filters[account_id] = bloom_filter
+        self._verified_bloom_filters.add(account_id)
+        return bloom_filter
+
+    def _build_bloom_filter(self, connection, account_id: str) -> BloomFilter:
+        count = self._count(connection, account_id)
+        bloom_filter = BloomFilter(max(count * 2, 10_000), self.bloom_error_rate, count)
+        if count:
+            rows = connection.execute(
+                f"SELECT id FROM {self.transaction_table_name} WHERE account = ?",
+                (account_id,),
+            )
+            bloom_filter.update(row[0] for row in rows)
+        self._bloom_filters[account_id] = bloom_filter
+        self._dirty_bloom_filters.add(account_id)
+        return bloom_filter
+
+    def _count(self, connection, account_id: str) -> int:
+        if not self._table_exists(connection):
+            return 0
+        return connection.execute(
+            f"SELECT COUNT(*) FROM {self.transaction_table_name} WHERE account = ?",
+            (account_id,),
+        ).fetchone()[0]
+
+    def _bloom_filter_path(self, account_id: str) -> Path:
+        return self.bloom_dir / f'{sha1(str(account_id).encode()).hexdigest()}.bloom'
+
+    def _save_bloom_filters(self):
+        for account_id in self._dirty_bloom_filters:
+            self._bloom_filters[account_id].save(self._bloom_filter_path(account_id))
+        self._dirty_bloom_filters.clear()
+
+    @synchronized
+    def get_watermark(self, account_id: str) -> datetime | None:
+        connection = self.get_connection()
+        self._create_sync_state_table(connection)
+        row = connection.execute(
+            f"SELECT last_transaction_datetime FROM {self.sync_state_table_name} WHERE account = ?",
+            (account_id,),
+        ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    @synchronized
+    def set_watermark(self, account_id: str, last_transaction_datetime: datetime):
+        connection = self.get_connection()
+        self._create_sync_state_table(connection)
+        connection.execute(
+            f"INSERT INTO {self.sync_state_table_name} (account, last_transaction_datetime) VALUES (?, ?) "
+            f"ON CONFLICT (account) DO UPDATE SET last_transaction_datetime = excluded.last_transaction_datetime "
+            f"WHERE excluded.last_transaction_datetime > last_transaction_datetime",
+            (account_id, last_transaction_datetime.isoformat()),
+        )
+        connection.commit()
+
+    def _create_sync_state_table(self, connection):
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.sync_state_table_name} ("
+            f"account TEXT PRIMARY KEY, "
+            f"last_transaction_datetime TEXT NOT NULL)"
+        )
+
+    @synchronized
+    def get_balance_fingerprint(self, account_id: str) -> str | None:
+        connection = self.get_connection()
+        self._create_balance_state_table(connection)
+        row = connection.execute(
+            f"SELECT balance_fingerprint FROM {self.balance_state_table_name} WHERE account = ?",
+            (account_id,),
+        ).fetchone()
+        return row[0] if row else None
+
+    @synchronized
+    def set_balance_fingerprint(self, account_id: str, balance_fingerprint: str):
+        connection = self.get_connection()
+        self._create_balance_state_table(connection)
+        connection.execute(
+            f"INSERT INTO {self.balance_state_table_name} (account, balance_fingerprint) VALUES (?, ?) "
+            f"ON CONFLICT (account) DO UPDATE SET balance_fingerprint = excluded.balance_fingerprint",
+            (account_id, balance_fingerprint),
+        )
+        connection.commit()
+
+    def _create_balance_state_table(self, connection):
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.balance_state_table_name} ("
+            f"account TEXT PRIMARY KEY, "
+            f"balance_fingerprint TEXT NOT NULL)"
         )
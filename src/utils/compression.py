@@ -0,0 +1,30 @@
+import gzip
+import io
+import zipfile
+
+COMPRESSION_MODES = ('gzip', 'zip')
+
+
+def compress(content: bytes, filename: str, mode: str | None) -> tuple[bytes, str]:
+    """
+    Compress file content for attaching.
+    Args:
+        content (bytes): File content.
+        filename (str): File name.
+        mode (str | None): gzip, zip or None for no compression.
+    Returns:
+        tuple[bytes, str]: Compressed content and its file name.
+    """
+
+    match mode:
+        case None | '' | 'none':
+            return content, filename
+        case 'gzip':
+            return gzip.compress(content), f'{filename}.gz'
+        case 'zip':
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(filename, content)
+            return buffer.getvalue(), f'{filename}.zip'
+        case _:
+            raise ValueError(f'Unsupported compression mode {mode}. Supported modes are {", ".join(COMPRESSION_MODES)}')
@@ -1,30 +1,143 @@
+import os
 import smtplib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
+from threading import Lock
+
+from src.utils.metrics import metrics
+
+
+@dataclass
+class DeliveryResult:
+    to: str
+    subject: str
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
 
 
 class SMTP:
+    """
+    SMTP client reusing one authenticated connection for all messages.
+    Messages are delivered one by one by a background worker, the connection is
+    re-established when the server drops it.
+    """
+
     def __init__(self, username: str, password: str, host: str, port: int, use_tls: bool = True):
         self.username = username
         self.password = password
         self.host = host
         self.port = port
         self.use_tls = use_tls
+        self._server = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='smtp')
+        self._futures = []
+        self._futures_lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send(
+            self,
+            to: str,
+            subject: str,
+            attached_file: str | None = None,
+            content: bytes | None = None,
+            filename: str | None = None,
+    ) -> DeliveryResult:
+        result = self.send_async(to, subject, attached_file, content, filename).result()
+        if result.error:
+            raise result.error
+        return result
+
+    def send_async(
+            self,
+            to: str,
+            subject: str,
+            attached_file: str | None = None,
+            content: bytes | None = None,
+            filename: str | None = None,
+    ) -> Future:
+        """
+        Queue a message for delivery. The attachment is either read from attached_file
+        before returning, so the file can be removed right away, or taken from content.
+        Args:
+            to (str): Recipient.
+            subject (str): Subject.
+            attached_file (str | None): Path of the file to attach.
+            content (bytes | None): Attachment content, used when attached_file is not set.
+            filename (str | None): Attachment name. Default is attached_file name.
+        Returns:
+            Future[DeliveryResult]: Delivery result.
+        """
+
+        if attached_file is not None:
+            with open(attached_file, "rb") as attachment:
+                content = attachment.read()
+            filename = filename or os.path.basename(attached_file)
 
-    def send(self, to: str, subject: str, attached_file: str):
         msg = MIMEMultipart()
         msg['From'] = self.username
         msg['To'] = to
         msg['Subject'] = subject
 
-        with open(attached_file, "rb") as attachment:
-            part = MIMEApplication(attachment.read(), Name=attached_file)
-            part['Content-Disposition'] = f'attachment; filename="{attached_file}"'
-            msg.attach(part)
-
-        server = smtplib.SMTP(self.host, self.port)
-        if self.use_tls:
-            server.starttls()
-        server.login(self.username, self.password)
-        server.sendmail(self.username, to, msg.as_string())
-        server.quit()
+        part = MIMEApplication(content, Name=filename)
+        part['Content-Disposition'] = f'attachment; filename="{filename}"'
+        msg.attach(part)
+
+        future = self._executor.submit(self._deliver, to, subject, msg.as_string())
+        with self._futures_lock:
+            self._futures.append(future)
+        return future
+
+    def results(self) -> list[DeliveryResult]:
+        """
+        Wait for all queued messages.
+        Returns:
+            list[DeliveryResult]: Results of messages queued since the previous call.
+        """
+
+        with self._futures_lock:
+            futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._server:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                pass
+            self._server = None
+
+    def _get_server(self):
+        if not self._server:
+            server = smtplib.SMTP(self.host, self.port)
+            if self.use_tls:
+                server.starttls()
+            server.login(self.username, self.password)
+            self._server = server
+        return self._server
+
+    def _deliver(self, to: str, subject: str, message: str) -> DeliveryResult:
+        try:
+            with metrics.timer('smtp.send'):
+                try:
+                    self._get_server().sendmail(self.username, to, message)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    metrics.increment('smtp.reconnects')
+                    self._server = None
+                    self._get_server().sendmail(self.username, to, message)
+        except Exception as error:
+            metrics.increment('smtp.errors')
+            return DeliveryResult(to=to, subject=subject, error=error)
+        metrics.increment('smtp.messages')
+        metrics.increment('smtp.bytes', len(message))
+        return DeliveryResult(to=to, subject=subject)
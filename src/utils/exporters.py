@@ -0,0 +1,218 @@
+import csv
+import io
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+from xml.sax.saxutils import escape
+
+from src.raiffeisen_rs.schema import normalize_transaction
+
+
+@dataclass(frozen=True)
+class Exporter:
+    name: str
+    extension: str
+    render: Callable[[list[dict], list[str]], bytes]
+    header: Callable[[list[str]], bytes] | None = None
+    dated: bool = False
+
+    @property
+    def streaming(self) -> bool:
+        """Whether files can be rendered batch by batch, as the header followed by the rendered batches."""
+        return self.header is not None
+
+
+EXPORTERS: dict[str, Exporter] = {}
+
+UNKNOWN_MONTH = 'unknown'
+
+
+def register_exporter(name: str, extension: str, header: Callable[[list[str]], bytes] | None = None,
+                      dated: bool = False):
+    """
+    Register a render function as an export format.
+    The function takes transaction rows and column names and returns their content.
+    With a header function, which takes column names, the format is streaming: the render function renders
+    only the rows and the file is the header followed by rendered batches. Otherwise the render function
+    gets all rows at once and renders the whole file.
+    Dated formats can't represent rows without a datetime and leave them out.
+    Both must be defined at module level, so they can be run in a process pool.
+    """
+
+    def decorator(render_func):
+        EXPORTERS[name] = Exporter(name=name, extension=extension, render=render_func, header=header, dated=dated)
+        return render_func
+    return decorator
+
+
+def render(export_format: str, rows: list[dict], columns: list[str]) -> bytes:
+    """
+    Render a whole file in an export format.
+    Args:
+        export_format (str): Registered format name, e.g. csv.
+        rows (list[dict]): Transactions as sent by the bank, tagged with the account number.
+        columns (list[str]): Column names.
+    Returns:
+        bytes: File content.
+    """
+
+    exporter = EXPORTERS[export_format]
+    content = exporter.render(rows, columns)
+    return exporter.header(columns) + content if exporter.streaming else content
+
+
+def render_batch(export_format: str, rows: list[dict], columns: list[str]) -> bytes:
+    """Render a batch of rows of a streaming format, without the header."""
+
+    return EXPORTERS[export_format].render(rows, columns)
+
+
+def split_by_month(rows: list[dict]) -> dict[str, list[dict]]:
+    """Group rows by YYYY-MM of their datetime, rows without a datetime go to the unknown month."""
+
+    months = {}
+    for row in rows:
+        transaction_datetime = normalize_transaction(row)['datetime']
+        month = transaction_datetime.strftime('%Y-%m') if transaction_datetime else UNKNOWN_MONTH
+        months.setdefault(month, []).append(row)
+    return months
+
+
+class ExportFile:
+    """
+    Export file written batch by batch through a temporary file in the same directory, which replaces
+    the file on commit, so readers never see a partial file. Without file_path the content is kept in memory.
+    Rows of formats which aren't streaming are collected in rows until the whole file is rendered.
+    """
+
+    def __init__(self, exporter: Exporter, columns: list[str], file_path: str | None = None):
+        self.exporter = exporter
+        self.file_path = file_path
+        self.rows: list[dict] = []
+        if file_path is None:
+            self._tmp_path = None
+            self._file = io.BytesIO()
+        else:
+            directory, filename = os.path.split(file_path)
+            self._tmp_path = os.path.join(directory, f'.{filename}.tmp')
+            self._file = open(self._tmp_path, 'wb')
+        if exporter.streaming:
+            self._file.write(exporter.header(columns))
+
+    def write(self, content: bytes):
+        self._file.write(content)
+
+    def getvalue(self) -> bytes:
+        return self._file.getvalue()
+
+    def commit(self):
+        if self._tmp_path:
+            self._file.close()
+            os.replace(self._tmp_path, self.file_path)
+
+    def discard(self):
+        if self._tmp_path:
+            self._file.close()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+
+
+def _amount(transaction: dict) -> float:
+    return (transaction['credit'] or 0.0) - (transaction['debit'] or 0.0)
+
+
+def _dated_transactions(rows: list[dict]):
+    """Normalized transactions of the rows that have a datetime."""
+
+    for row in rows:
+        transaction = normalize_transaction(row)
+        if transaction['datetime'] is not None:
+            yield transaction
+
+
+def csv_header(columns: list[str]) -> bytes:
+    buffer = io.StringIO(newline='')
+    csv.DictWriter(buffer, fieldnames=columns).writeheader()
+    return buffer.getvalue().encode('utf-8')
+
+
+def jsonl_header(columns: list[str]) -> bytes:
+    return b''
+
+
+def qif_header(columns: list[str]) -> bytes:
+    return b'!Type:Bank\n'
+
+
+@register_exporter('csv', 'csv', header=csv_header)
+def render_csv(rows: list[dict], columns: list[str]) -> bytes:
+    buffer = io.StringIO(newline='')
+    csv.DictWriter(buffer, fieldnames=columns).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+@register_exporter('jsonl', 'jsonl', header=jsonl_header)
+def render_jsonl(rows: list[dict], columns: list[str]) -> bytes:
+    return ''.join(
+        json.dumps({column: row.get(column) for column in columns}, ensure_ascii=False, default=str) + '\n'
+        for row in rows
+    ).encode('utf-8')
+
+
+@register_exporter('ofx', 'ofx', dated=True)
+def render_ofx(rows: list[dict], columns: list[str]) -> bytes:
+    transactions = sorted(_dated_transactions(rows), key=lambda row: row['datetime'])
+    account = str(transactions[0]['account']) if transactions else ''
+    currency = transactions[0]['currency'] if transactions else ''
+
+    def ofx_datetime(dt: datetime) -> str:
+        return dt.strftime('%Y%m%d%H%M%S')
+
+    statement_transactions = ''.join(
+        '<STMTTRN>'
+        f'<TRNTYPE>{"CREDIT" if _amount(transaction) >= 0 else "DEBIT"}</TRNTYPE>'
+        f'<DTPOSTED>{ofx_datetime(transaction["datetime"])}</DTPOSTED>'
+        f'<TRNAMT>{_amount(transaction):.2f}</TRNAMT>'
+        f'<FITID>{escape(str(transaction["id"]))}</FITID>'
+        f'<NAME>{escape((transaction.get("title") or "")[:32])}</NAME>'
+        f'<MEMO>{escape(transaction.get("description") or "")}</MEMO>'
+        '</STMTTRN>'
+        for transaction in transactions
+    )
+    now = ofx_datetime(datetime.now())
+    start = ofx_datetime(transactions[0]['datetime']) if transactions else now
+    end = ofx_datetime(transactions[-1]['datetime']) if transactions else now
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+        '<?OFX OFXHEADER="200" VERSION="202" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>\n'
+        '<OFX>'
+        '<SIGNONMSGSRSV1><SONRS>'
+        '<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>'
+        f'<DTSERVER>{now}</DTSERVER><LANGUAGE>ENG</LANGUAGE>'
+        '</SONRS></SIGNONMSGSRSV1>'
+        '<BANKMSGSRSV1><STMTTRNRS><TRNUID>0</TRNUID>'
+        '<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>'
+        f'<STMTRS><CURDEF>{escape(currency or "")}</CURDEF>'
+        f'<BANKACCTFROM><BANKID>{escape(account[:3])}</BANKID><ACCTID>{escape(account)}</ACCTID>'
+        '<ACCTTYPE>CHECKING</ACCTTYPE></BANKACCTFROM>'
+        f'<BANKTRANLIST><DTSTART>{start}</DTSTART><DTEND>{end}</DTEND>{statement_transactions}</BANKTRANLIST>'
+        '</STMTRS></STMTTRNRS></BANKMSGSRSV1>'
+        '</OFX>\n'
+    ).encode('utf-8')
+
+
+@register_exporter('qif', 'qif', header=qif_header, dated=True)
+def render_qif(rows: list[dict], columns: list[str]) -> bytes:
+    lines = []
+    for transaction in _dated_transactions(rows):
+        lines.append(f'D{transaction["datetime"].strftime("%d/%m/%Y")}')
+        lines.append(f'T{_amount(transaction):.2f}')
+        if transaction.get('title'):
+            lines.append(f'P{" ".join(transaction["title"].splitlines())}')
+        if transaction.get('description'):
+            lines.append(f'M{" ".join(transaction["description"].splitlines())}')
+        lines.append(f'N{transaction["id"]}')
+        lines.append('^')
+    return ''.join(f'{line}\n' for line in lines).encode('utf-8')
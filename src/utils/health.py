@@ -0,0 +1,56 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Callable
+
+
+class HealthServer:
+    """
+    Local HTTP server for health checks and metrics scraping.
+    GET /health answers with the JSON from health(), with status 503 when it isn't ok.
+    GET /metrics answers with the text from metrics(), e.g. in the Prometheus format.
+    """
+
+    def __init__(self, host: str, port: int, health: Callable[[], dict], metrics: Callable[[], str]):
+        self.health = health
+        self.metrics = metrics
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = Thread(target=self.server.serve_forever, name='health-server', daemon=True)
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/health':
+                    health = server.health()
+                    self._respond(200 if health.get('ok') else 503, 'application/json', json.dumps(health))
+                elif self.path == '/metrics':
+                    self._respond(200, 'text/plain; version=0.0.4', server.metrics())
+                else:
+                    self._respond(404, 'text/plain', 'Not found\n')
+
+            def _respond(self, status, content_type, body):
+                content = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,8 @@
+from itertools import islice
+from typing import Iterable, Iterator
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
@@ -0,0 +1,118 @@
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from functools import wraps
+from threading import Lock
+from typing import Callable, Iterator
+
+METRICS_FORMATS = ('json', 'prometheus')
+
+
+@dataclass
+class Timer:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+
+class Metrics:
+    """
+    Thread-safe run metrics: timers (call count, total and max seconds) and counters.
+    Timers running in several threads at once add up their time, so a stage total may exceed the run time.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.timers: dict[str, Timer] = {}
+        self.counters: dict[str, float] = {}
+        self.started_at = time.time()
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at)
+
+    def timed(self, name: str) -> Callable:
+        """Decorator timing every call of the function."""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            timer = self.timers.setdefault(name, Timer())
+            timer.count += 1
+            timer.total += seconds
+            timer.max = max(timer.max, seconds)
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.started_at = time.time()
+
+    def summary(self) -> dict:
+        """
+        Get the run summary.
+        Returns:
+            dict: Run start timestamp, duration in seconds, timers and counters by name.
+        """
+
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'duration': time.time() - self.started_at,
+                'timers': {name: asdict(timer) for name, timer in sorted(self.timers.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary())
+
+    def to_prometheus(self, prefix: str = 'raiffeisen_export') -> str:
+        """Render the run summary in the Prometheus text exposition format, e.g. for node_exporter textfiles."""
+
+        summary = self.summary()
+        lines = [
+            f'{prefix}_last_run_timestamp_seconds {summary["started_at"]:.3f}',
+            f'{prefix}_last_run_duration_seconds {summary["duration"]:.6f}',
+        ]
+        for name, timer in summary['timers'].items():
+            metric = f'{prefix}_{_metric_name(name)}'
+            lines.append(f'{metric}_calls_total {timer["count"]}')
+            lines.append(f'{metric}_seconds_total {timer["total"]:.6f}')
+            lines.append(f'{metric}_seconds_max {timer["max"]:.6f}')
+        for name, value in summary['counters'].items():
+            lines.append(f'{prefix}_{_metric_name(name)}_total {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_path: str, output_format: str = 'json'):
+        """Write the run summary atomically, so a collector never reads a partial file."""
+
+        content = self.to_prometheus() if output_format == 'prometheus' else self.to_json()
+        tmp_path = f'{file_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+metrics = Metrics()
@@ -0,0 +1,98 @@
+import queue
+from dataclasses import dataclass
+from threading import Lock, Thread
+from typing import Any, Callable, Iterable
+
+from src.utils.metrics import metrics
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+@dataclass
+class StageError:
+    stage: str
+    item: Any
+    error: Exception
+
+
+class Pipeline:
+    """
+    Threaded pipeline of stages connected by bounded queues.
+    Every stage function takes an item and returns the item for the next stage or None to drop it.
+    An item failing in a stage is dropped and reported in the run result.
+    """
+
+    def __init__(self, queue_size: int = 4):
+        self.queue_size = queue_size
+        self.stages: list[Stage] = []
+
+    def add_stage(self, name: str, func: Callable[[Any], Any], workers: int = 1) -> 'Pipeline':
+        self.stages.append(Stage(name=name, func=func, workers=max(workers, 1)))
+        return self
+
+    def run(self, items: Iterable) -> list[StageError]:
+        """
+        Push items through all stages and wait until every stage is drained.
+        Returns:
+            list[StageError]: Errors raised by stage functions.
+        """
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        errors = []
+        errors_lock = Lock()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            next_queue = queues[index + 1] if next_stage else None
+            state = {'remaining': stage.workers, 'lock': Lock()}
+            for number in range(stage.workers):
+                thread = Thread(
+                    target=self._work,
+                    args=(stage, queues[index], next_stage, next_queue, state, errors, errors_lock),
+                    name=f'{stage.name}-{number}',
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+        return errors
+
+    @staticmethod
+    def _work(stage, inbox, next_stage, next_queue, state, errors, errors_lock):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                with state['lock']:
+                    state['remaining'] -= 1
+                    last = state['remaining'] == 0
+                if last and next_queue is not None:
+                    for _ in range(next_stage.workers):
+                        next_queue.put(_DONE)
+                return
+
+            try:
+                with metrics.timer(f'pipeline.{stage.name}'):
+                    result = stage.func(item)
+            except Exception as error:
+                metrics.increment(f'pipeline.{stage.name}.errors')
+                with errors_lock:
+                    errors.append(StageError(stage=stage.name, item=item, error=error))
+                continue
+
+            if result is not None and next_queue is not None:
+                next_queue.put(result)
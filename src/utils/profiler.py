@@ -0,0 +1,44 @@
+import cProfile
+import pstats
+import threading
+from threading import Lock
+
+
+class Profiler:
+    """
+    cProfile for all threads of the run.
+    cProfile only records the thread that enabled it, so every thread started after start
+    gets its own profiler and the stats of all threads are merged on dump.
+    Processes of the render pool are not profiled.
+    """
+
+    def __init__(self):
+        self._profiles: list[cProfile.Profile] = []
+        self._lock = Lock()
+
+    def start(self):
+        threading.setprofile(self._profile_thread)
+        self._enable()
+
+    def stop(self):
+        threading.setprofile(None)
+        self._profiles[0].disable()
+
+    def dump(self, file_path: str):
+        """Merge the stats of all threads and write them in the pstats format."""
+
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        stats.add(*profiles[1:])
+        stats.dump_stats(file_path)
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def _profile_thread(self, frame, event, arg):
+        # Called on the first event of a new thread, enabling the profiler replaces this hook
+        self._enable()
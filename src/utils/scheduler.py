@@ -0,0 +1,78 @@
+import heapq
+import random
+import time
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from typing import Hashable
+
+
+@dataclass(order=True)
+class Job:
+    next_run: float
+    key: Hashable = field(compare=False)
+    interval: float = field(compare=False)
+    jitter: float = field(compare=False, default=0.0)
+
+
+class Scheduler:
+    """
+    Runs keyed jobs at fixed intervals.
+    Every run is shifted by a random delay of up to jitter seconds, so jobs with the same
+    interval don't hit the bank at the same moment. The scheduler only tells which jobs are due,
+    running them is up to the caller.
+    """
+
+    def __init__(self):
+        self._jobs: list[Job] = []
+        self._lock = Lock()
+        self._stop_event = Event()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def add(self, key: Hashable, interval: float, jitter: float = 0.0, delay: float = 0.0):
+        """
+        Schedule a job.
+        Args:
+            key (Hashable): Job key returned by wait when the job is due.
+            interval (float): Seconds between runs.
+            jitter (float): Max random delay in seconds added to every run. Default is 0.
+            delay (float): Seconds before the first run. Default is 0.
+        """
+
+        with self._lock:
+            heapq.heappush(self._jobs, Job(time.monotonic() + delay, key, interval, jitter))
+
+    def remove(self, key: Hashable):
+        with self._lock:
+            self._jobs = [job for job in self._jobs if job.key != key]
+            heapq.heapify(self._jobs)
+
+    def wait(self) -> list[Hashable]:
+        """
+        Wait until at least one job is due or the scheduler is stopped, and schedule the next runs of due jobs.
+        Returns:
+            list[Hashable]: Keys of due jobs, empty when stopped.
+        """
+
+        while not self.stopped:
+            with self._lock:
+                now = time.monotonic()
+                if not self._jobs:
+                    timeout = None
+                elif self._jobs[0].next_run <= now:
+                    due = []
+                    while self._jobs and self._jobs[0].next_run <= now:
+                        due.append(heapq.heappop(self._jobs))
+                    for job in due:
+                        job.next_run = now + job.interval + random.uniform(0, job.jitter)
+                        heapq.heappush(self._jobs, job)
+                    return [job.key for job in due]
+                else:
+                    timeout = self._jobs[0].next_run - now
+            self._stop_event.wait(timeout)
+        return []
+
+    def stop(self):
+        self._stop_event.set()